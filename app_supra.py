@@ -1,9 +1,15 @@
 import streamlit as st
 import mysql.connector
+from mysql.connector.constants import ClientFlag
 import pandas as pd
 from datetime import datetime
 import io
 import re
+import time
+import threading
+import os
+import json
+import shutil
 
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(page_title="SUPRA | Gestión de Planta BRODA PRO", layout="wide")
@@ -27,56 +33,484 @@ st.markdown("""
     """, unsafe_allow_html=True)
 
 # --- FUNCIONES DE SOPORTE ---
-def get_db_connection():
+def _conectar(lectura=False):
+    # Lecturas: endpoint DB_READ_* si está configurado (réplica); si no, el mismo servidor
+    pre = "DB_READ_" if lectura else "DB_"
+    return mysql.connector.connect(
+        host=st.secrets.get(f"{pre}HOST", st.secrets["DB_HOST"]),
+        user=st.secrets.get(f"{pre}USER", st.secrets["DB_USER"]),
+        password=st.secrets.get(f"{pre}PASS", st.secrets["DB_PASS"]),
+        database=st.secrets.get(f"{pre}NAME", st.secrets["DB_NAME"]),
+        # rowcount = filas encontradas (no solo modificadas): un UPDATE versionado que no cambia
+        # ningún valor (p. ej. redondeo al DECIMAL guardado) no se confunde con un conflicto de edición
+        client_flags=[ClientFlag.FOUND_ROWS]
+    )
+
+def get_db_connection(lectura=False):
+    # Contador por rerun (se muestra al pie del sidebar para medir el costo de cada vista)
+    st.session_state['_db_conexiones_rerun'] = st.session_state.get('_db_conexiones_rerun', 0) + 1
     try:
-        return mysql.connector.connect(
-            host=st.secrets["DB_HOST"],
-            user=st.secrets["DB_USER"],
-            password=st.secrets["DB_PASS"],
-            database=st.secrets["DB_NAME"]
-        )
+        return _conectar(lectura)
     except Exception as e:
         st.error(f"Error de conexión: {e}")
         return None
 
-def recalcular_costos_cascada():
+def get_read_connection(replica=True):
+    """Conexión para reportes: transacción de solo lectura con snapshot consistente (REPEATABLE READ).
+    Todas las consultas del reporte ven el mismo punto en el tiempo y no esperan locks de escrituras.
+    Con replica=False se lee del primario (datos que se van a editar a continuación)."""
+    conn = get_db_connection(lectura=replica)
+    if conn:
+        conn.start_transaction(consistent_snapshot=True, isolation_level="REPEATABLE READ", readonly=True)
+    return conn
+
+# --- SNAPSHOT LOCAL COLUMNAR (PARQUET) ---
+# Configurable (SUPRA_SNAPSHOT_DIR) para que pruebas y entornos de prueba no compartan el snapshot de producción
+SNAPSHOT_DIR = os.environ.get("SUPRA_SNAPSHOT_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot_supra")
+SNAPSHOT_MAX_EDAD_S = 3600   # aunque no haya escrituras en este proceso, se regenera cada hora
+SNAPSHOT_DEBOUNCE_S = 20     # agrupa ráfagas de guardados en un solo refresco
+SNAPSHOT_CONSULTAS = {
+    'ingredientes_supra': """
+        SELECT codigo_ingrediente, descripcion, um, costo_total_envase, cantidad_envase, costo_unitario, proveedor,
+               MD5(CONCAT_WS('|', descripcion, um, costo_total_envase, cantidad_envase, proveedor)) as _ver
+        FROM ingredientes_supra ORDER BY codigo_ingrediente DESC
+    """,
+    'componentes_maestro': "SELECT codigo_componente, nombre_receta, costo_total_calculado FROM componentes_maestro ORDER BY codigo_componente DESC",
+    'componentes_detalle': "SELECT codigo_padre, codigo_hijo, cantidad_bruta FROM componentes_detalle",
+    'clasificacion_supra': "SELECT codigo, tipo, sub_division, codigo_final FROM clasificacion_supra",
+    'platos_maestro': "SELECT codigo_plato_supra, nombre_plato, id_clasificacion, peso_total_gramos, costo_total_calculado FROM platos_maestro",
+    'platos_detalle': "SELECT id_detalle_plato, codigo_plato_padre, codigo_hijo, cantidad_bruta, porcentaje_merma, cantidad_neta FROM platos_detalle",
+}
+
+@st.cache_resource
+def _snapshot_store():
+    # escrituras: secuencia de escrituras vistas por el proceso; seq_volcado: la que cubre el snapshot en disco
+    # (None hasta el primer volcado del proceso: un snapshot heredado no se da por vigente)
+    return {"lock": threading.Lock(), "escrituras": 0, "seq_volcado": None, "refrescando": False, "version": None, "tablas": {}}
+
+def _normalizar_para_parquet(df):
+    # DECIMAL llega como decimal.Decimal (object): se pasa a float64; el resto de object queda como texto
+    from decimal import Decimal
+    for c in df.columns:
+        if df[c].dtype == object:
+            muestra = df[c].dropna()
+            if not muestra.empty and isinstance(muestra.iloc[0], Decimal):
+                df[c] = pd.to_numeric(df[c], errors='coerce').astype('float64')
+            else:
+                df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    return df
+
+def escribir_snapshot():
+    """Vuelca maestros y detalles a Parquet desde una única lectura consistente del primario.
+    Se escribe en un directorio temporal y se reemplaza el anterior de una vez."""
+    conn = _conectar()
+    try:
+        conn.start_transaction(consistent_snapshot=True, isolation_level="REPEATABLE READ", readonly=True)
+        frames = {t: _normalizar_para_parquet(pd.read_sql(q, conn)) for t, q in SNAPSHOT_CONSULTAS.items()}
+    finally:
+        conn.close()
+
+    tmp, viejo = SNAPSHOT_DIR + ".tmp", SNAPSHOT_DIR + ".old"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for t, df in frames.items():
+        df.to_parquet(os.path.join(tmp, f"{t}.parquet"), index=False)
+    with open(os.path.join(tmp, "manifiesto.json"), "w") as f:
+        json.dump({"generado": time.time(), "filas": {t: len(df) for t, df in frames.items()}}, f)
+    shutil.rmtree(viejo, ignore_errors=True)
+    if os.path.isdir(SNAPSHOT_DIR): os.replace(SNAPSHOT_DIR, viejo)
+    os.replace(tmp, SNAPSHOT_DIR)
+    shutil.rmtree(viejo, ignore_errors=True)
+
+def _manifiesto_snapshot():
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, "manifiesto.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def leer_snapshot():
+    """Tablas del snapshot (una sola copia en memoria por proceso y por versión), o None si no hay."""
+    man = _manifiesto_snapshot()
+    if not man: return None
+    store = _snapshot_store()
+    with store["lock"]:
+        if store["version"] != man["generado"]:
+            try:
+                store["tablas"] = {t: pd.read_parquet(os.path.join(SNAPSHOT_DIR, f"{t}.parquet")) for t in SNAPSHOT_CONSULTAS}
+                store["version"] = man["generado"]
+            except Exception:
+                return None
+        return {"generado": man["generado"], **store["tablas"]}
+
+def snapshot_vigente():
+    man = _manifiesto_snapshot()
+    store = _snapshot_store()
+    with store["lock"]:
+        al_dia = store["seq_volcado"] is not None and store["seq_volcado"] == store["escrituras"]
+    return bool(man) and al_dia and time.time() - man["generado"] < SNAPSHOT_MAX_EDAD_S
+
+def programar_refresco_snapshot(demora=SNAPSHOT_DEBOUNCE_S):
+    # Un solo hilo de refresco por proceso; no bloquea el rerun de nadie
+    store = _snapshot_store()
+    with store["lock"]:
+        if store["refrescando"]: return
+        store["refrescando"] = True
+
+    def _tarea():
+        pendiente = False
+        try:
+            time.sleep(demora)
+            with store["lock"]: seq = store["escrituras"]
+            escribir_snapshot()
+            # Vigente solo después del reemplazo del directorio, y solo hasta la secuencia leída al empezar:
+            # una escritura llegada durante el volcado deja el snapshot desactualizado y pide otro
+            with store["lock"]:
+                store["seq_volcado"] = seq
+                pendiente = store["escrituras"] != seq
+        except Exception:
+            pass  # sigue sin estar vigente; el próximo asegurar_snapshot() lo reintenta
+        finally:
+            with store["lock"]: store["refrescando"] = False
+        if pendiente: programar_refresco_snapshot()
+
+    threading.Thread(target=_tarea, daemon=True).start()
+
+def secuencia_escrituras():
+    # Cambia con cada escritura del proceso: sirve para descartar exportes armados antes
+    store = _snapshot_store()
+    with store["lock"]: return store["escrituras"]
+
+def marcar_snapshot_desactualizado():
+    store = _snapshot_store()
+    with store["lock"]: store["escrituras"] += 1
+    programar_refresco_snapshot()
+
+def asegurar_snapshot():
+    man = _manifiesto_snapshot()
+    if not man or _snapshot_store()["seq_volcado"] is None:
+        programar_refresco_snapshot(demora=0)
+    elif not snapshot_vigente():
+        programar_refresco_snapshot()
+
+def aviso_snapshot(snap):
+    st.caption(f"🗂️ Datos del snapshot local ({datetime.fromtimestamp(snap['generado']).strftime('%d/%m/%Y %H:%M')})")
+
+# --- ESCRITURA CONCURRENTE: TRANSACCIONES CORTAS, LOTES Y REINTENTOS ---
+LOTE_ESCRITURA = 200     # filas por transacción en importaciones y cascada
+LOTE_PLATOS = 25         # platos (cabecera + detalle) por transacción
+LOCK_WAIT_S = 10         # si una fila está tomada, se falla rápido y se reintenta el lote
+MAX_REINTENTOS = 3
+ERRNO_LOCK_WAIT, ERRNO_DEADLOCK = 1205, 1213
+
+@st.cache_resource
+def _contencion_store():
+    # Métricas de contención a nivel proceso (todas las sesiones)
+    return {"lock": threading.Lock(), "esperas_lock": 0, "deadlocks": 0, "reintentos": 0,
+            "conflictos_edicion": 0, "lotes": 0, "lote_max_ms": 0.0}
+
+def registrar_contencion(clave, valor=1):
+    store = _contencion_store()
+    with store["lock"]:
+        if clave == "lote_max_ms": store[clave] = max(store[clave], valor)
+        else: store[clave] += valor
+
+def preparar_sesion_escritura(conn):
+    cursor = conn.cursor()
+    cursor.execute(f"SET SESSION innodb_lock_wait_timeout = {int(LOCK_WAIT_S)}")
+    cursor.close()
+
+def iterar_lotes(seq, tam):
+    seq = list(seq)
+    for k in range(0, len(seq), tam):
+        yield seq[k:k + tam]
+
+def ejecutar_con_reintentos(conn, operacion):
+    # operacion(cursor) corre en su propia transacción corta; ante lock wait/deadlock se reintenta con backoff
+    for intento in range(MAX_REINTENTOS + 1):
+        cursor = conn.cursor()
+        try:
+            t0 = time.perf_counter()
+            resultado = operacion(cursor)
+            conn.commit()
+            registrar_contencion("lotes")
+            registrar_contencion("lote_max_ms", (time.perf_counter() - t0) * 1000)
+            return resultado
+        except mysql.connector.Error as e:
+            conn.rollback()
+            if e.errno not in (ERRNO_LOCK_WAIT, ERRNO_DEADLOCK) or intento == MAX_REINTENTOS: raise
+            registrar_contencion("esperas_lock" if e.errno == ERRNO_LOCK_WAIT else "deadlocks")
+            registrar_contencion("reintentos")
+            time.sleep(0.2 * (2 ** intento))
+        finally:
+            cursor.close()
+
+def ejecutar_en_lotes(conn, sql, filas, tam=LOTE_ESCRITURA):
+    for lote in iterar_lotes(filas, tam):
+        ejecutar_con_reintentos(conn, lambda cur, lote=lote: cur.executemany(sql, lote))
+
+def filas_editadas(original, editado, columnas):
+    # Filas del data_editor que difieren del snapshot leído (NaN == NaN)
+    a = original[columnas].astype(object).where(original[columnas].notna(), "")
+    b = editado[columnas].astype(object).where(editado[columnas].notna(), "")
+    return editado[(a != b).any(axis=1)]
+
+def _marcas(valores):
+    return ", ".join(["%s"] * len(valores))
+
+def guardar_insumos_versionados(conn, filas):
+    """filas: (descripcion, um, costo_total_envase, cantidad_envase, costo_unitario, proveedor, codigo, _ver).
+    Concurrencia optimista: cada fila se escribe solo si sigue como se leyó (_ver). Devuelve los códigos rechazados."""
+    def _guardar_lote(cursor, lote):
+        rechazados = []
+        for f in lote:
+            cursor.execute("""
+                UPDATE ingredientes_supra 
+                SET descripcion=%s, um=%s, costo_total_envase=%s, cantidad_envase=%s, costo_unitario=%s, proveedor=%s 
+                WHERE codigo_ingrediente=%s
+                  AND MD5(CONCAT_WS('|', descripcion, um, costo_total_envase, cantidad_envase, proveedor)) = %s
+            """, f)
+            if cursor.rowcount == 0: rechazados.append(str(f[6]))
+        return rechazados
+
+    conflictos = []
+    for lote in iterar_lotes(filas, LOTE_ESCRITURA):
+        conflictos += ejecutar_con_reintentos(conn, lambda cur, lote=lote: _guardar_lote(cur, lote))
+    return conflictos
+
+# --- MOTOR DE COSTEO (VECTORIZADO) ---
+# Única definición de costo/peso de una receta: la usan la cascada, las vistas previas, el editor y el dashboard.
+# Costo sobre lo comprado (Bruto), peso sobre lo que queda (Neto).
+FC_TARGET = 0.35  # Food Cost Objetivo de SUPRA: Venta Sugerida = Costo / FC
+
+def cantidad_neta(bruta, merma_pct):
+    # Escalares o Series: Neto = Bruto * (1 - Merma%)
+    return bruta * (1 - (merma_pct / 100.0))
+
+def costear_lineas(lineas, precios):
+    """Agrega costo_un y subtotal a cada línea [codigo_hijo, cantidad_bruta]. `precios` es una Serie
+    codigo (numérico) -> costo unitario, p. ej. get_catalogo()["costos"]. Ítems sin precio cuestan 0."""
+    codigos = pd.to_numeric(lineas['codigo_hijo'].astype(str).str.strip(), errors='coerce')
+    costo_un = codigos.map(precios).astype('float64')
+    return lineas.assign(costo_un=costo_un, subtotal=lineas['cantidad_bruta'].astype('float64') * costo_un.fillna(0.0))
+
+def indicadores_costo(df, costo='costo_total', peso='peso_total_gramos', fc_target=FC_TARGET):
+    # Costo x KG, Venta Sugerida (Costo / FC) y Margen de Contribución a partir de costo y peso ya conocidos
+    costo_total = df[costo].astype('float64')
+    venta = costo_total / fc_target
+    return df.assign(costo_kg=costo_total / (df[peso].astype('float64') / 1000).replace(0, float('nan')),
+                     venta_sugerida=venta, margen=venta - costo_total)
+
+def costear_recetas(lineas, precios, clave='codigo_plato_padre', fc_target=FC_TARGET):
+    """Una fila por receta (índice = `clave`): costo_total y, si las líneas traen cantidad_neta,
+    peso_total_gramos, costo_kg, venta_sugerida y margen. Sirve igual para un plato o para miles."""
+    lineas = costear_lineas(lineas, precios)
+    grupos = lineas.groupby(clave, sort=False)
+    res = pd.DataFrame({'costo_total': grupos['subtotal'].sum()})
+    if 'cantidad_neta' not in lineas: return res
+    res['peso_total_gramos'] = grupos['cantidad_neta'].sum().astype('float64')
+    return indicadores_costo(res, fc_target=fc_target)
+
+def precios_db(cursor, codigos, componentes=True):
+    """Mapa de precios vigente en la DB para los ítems pedidos (el insumo pisa al componente, como el COALESCE de siempre).
+    Lectura con lock compartido: hasta el commit nadie puede cambiar esos precios por debajo del cálculo."""
+    precios = {}
+    for lote in iterar_lotes(sorted(set(codigos)), LOTE_ESCRITURA):
+        if componentes:
+            cursor.execute(f"SELECT codigo_componente, costo_total_calculado FROM componentes_maestro WHERE codigo_componente IN ({_marcas(lote)}) LOCK IN SHARE MODE", tuple(lote))
+            precios.update({int(r[0]): float(r[1] or 0) for r in cursor.fetchall()})
+        cursor.execute(f"SELECT codigo_ingrediente, costo_unitario FROM ingredientes_supra WHERE codigo_ingrediente IN ({_marcas(lote)}) AND costo_unitario IS NOT NULL LOCK IN SHARE MODE", tuple(lote))
+        precios.update({int(r[0]): float(r[1]) for r in cursor.fetchall()})
+    return pd.Series(precios, dtype='float64')
+
+def _lineas_db(cursor, sql, claves, columnas):
+    filas = []
+    for lote in iterar_lotes(list(claves), LOTE_ESCRITURA):
+        cursor.execute(sql.format(marcas=_marcas(lote)), tuple(lote))
+        filas += cursor.fetchall()
+    df = pd.DataFrame(filas, columns=columnas)
+    for c in columnas[2:]: df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0)
+    return df
+
+def _codigos_hijos(lineas):
+    return [int(h) for h in pd.to_numeric(lineas['codigo_hijo'].astype(str), errors='coerce').dropna()]
+
+def _recostear_componentes(cursor, lote):
+    # Lock de las cabeceras a recalcular + lock compartido de líneas y precios: leer, calcular y escribir
+    # quedan dentro de la misma transacción, como lo hacía el UPDATE ... JOIN
+    cursor.execute(f"SELECT codigo_componente FROM componentes_maestro WHERE codigo_componente IN ({_marcas(lote)}) FOR UPDATE", tuple(lote))
+    cursor.fetchall()
+    lineas = _lineas_db(cursor, "SELECT codigo_padre, codigo_hijo, cantidad_bruta FROM componentes_detalle WHERE codigo_padre IN ({marcas}) LOCK IN SHARE MODE",
+                        lote, ['codigo_padre', 'codigo_hijo', 'cantidad_bruta'])
+    # Componentes: solo insumos, Costo s/ Bruto
+    costos = costear_recetas(lineas, precios_db(cursor, _codigos_hijos(lineas), componentes=False), clave='codigo_padre')['costo_total']
+    if not costos.empty:
+        cursor.executemany("UPDATE componentes_maestro SET costo_total_calculado = %s WHERE codigo_componente = %s",
+                           [(float(c), str(k)) for k, c in costos.items()])
+
+def _recostear_platos(cursor, lote):
+    cursor.execute(f"SELECT codigo_plato_supra FROM platos_maestro WHERE codigo_plato_supra IN ({_marcas(lote)}) FOR UPDATE", tuple(lote))
+    cursor.fetchall()
+    lineas = _lineas_db(cursor, "SELECT codigo_plato_padre, codigo_hijo, cantidad_bruta, cantidad_neta FROM platos_detalle WHERE codigo_plato_padre IN ({marcas}) LOCK IN SHARE MODE",
+                        lote, ['codigo_plato_padre', 'codigo_hijo', 'cantidad_bruta', 'cantidad_neta'])
+    # Platos Finales: Costo s/ Bruto, Peso s/ Neto (mínimo 1 g)
+    res = costear_recetas(lineas, precios_db(cursor, _codigos_hijos(lineas)))
+    if not res.empty:
+        cursor.executemany("UPDATE platos_maestro SET costo_total_calculado = %s, peso_total_gramos = %s WHERE codigo_plato_supra = %s",
+                           [(float(r.costo_total), max(float(r.peso_total_gramos), 1.0), str(r.Index)) for r in res.itertuples()])
+
+# --- HUELLAS: LAS IMPORTACIONES SOLO ESCRIBEN LO QUE CAMBIÓ ---
+def _norm_huella(v):
+    # Misma representación para lo que viene del Excel (float/str) y de MySQL (Decimal/int)
+    if v is None or (isinstance(v, float) and pd.isna(v)): return ""
+    if isinstance(v, (int, float)) or type(v).__name__ == "Decimal": return f"{float(v):.4f}"
+    return str(v).strip().upper()
+
+def huella(*valores):
+    import hashlib
+    return hashlib.md5("|".join(_norm_huella(v) for v in valores).encode()).hexdigest()
+
+def huella_plato(nombre, id_clasificacion, peso_gramos, lineas):
+    """Cabecera + líneas (codigo_hijo, cantidad_bruta, porcentaje_merma), sin importar el orden de las líneas."""
+    peso = None if peso_gramos is None or pd.isna(peso_gramos) else round(float(peso_gramos), 2)
+    return huella(nombre, id_clasificacion, peso, *sorted(huella(*l) for l in lineas))
+
+def huellas_platos_db(cursor, pids):
+    # Huella actual de cada plato existente, leída en bloques (cabeceras + detalle)
+    res = {}
+    for lote in iterar_lotes(pids, LOTE_ESCRITURA):
+        cursor.execute(f"SELECT codigo_plato_supra, nombre_plato, id_clasificacion, peso_total_gramos FROM platos_maestro WHERE codigo_plato_supra IN ({_marcas(lote)})", tuple(lote))
+        cabeceras = {str(r[0]): r[1:] for r in cursor.fetchall()}
+        cursor.execute(f"SELECT codigo_plato_padre, codigo_hijo, cantidad_bruta, porcentaje_merma FROM platos_detalle WHERE codigo_plato_padre IN ({_marcas(lote)})", tuple(lote))
+        lineas = {}
+        for r in cursor.fetchall():
+            lineas.setdefault(str(r[0]), []).append((str(r[1]), r[2], r[3]))
+        for pid, (nombre, id_cls, peso) in cabeceras.items():
+            res[pid] = huella_plato(nombre, id_cls, peso, lineas.get(pid, []))
+    return res
+
+def huellas_insumos_db(cursor, codigos):
+    res = {}
+    for lote in iterar_lotes(codigos, LOTE_ESCRITURA):
+        cursor.execute(f"SELECT codigo_ingrediente, descripcion, um, costo_total_envase, cantidad_envase FROM ingredientes_supra WHERE codigo_ingrediente IN ({_marcas(lote)})", tuple(lote))
+        res.update({str(r[0]): huella(*r[1:]) for r in cursor.fetchall()})
+    return res
+
+def recalcular_costos_cascada(insumos=None, componentes=None, platos=None):
+    """Recalcula costos de componentes y platos. Sin argumentos recorre todo el catálogo;
+    con códigos, solo lo afectado por esos insumos/componentes/platos. Siempre en lotes cortos."""
     conn = get_db_connection()
     if not conn: return
     cursor = conn.cursor()
+    completo, plts = insumos is None and componentes is None and platos is None, []
     try:
-        # 1. Update Componentes (Si componentes_detalle usa cantidad_bruta)
-        cursor.execute("""
-            UPDATE componentes_maestro cm
-            INNER JOIN (
-                SELECT d.codigo_padre, COALESCE(SUM(d.cantidad_bruta * i.costo_unitario), 0) as nuevo_costo
-                FROM componentes_detalle d
-                JOIN ingredientes_supra i ON d.codigo_hijo = i.codigo_ingrediente
-                GROUP BY d.codigo_padre
-            ) calculo ON cm.codigo_componente = calculo.codigo_padre
-            SET cm.costo_total_calculado = calculo.nuevo_costo
-        """)
-        
-        # 2. Update Platos Finales (Costo s/ Bruto, Peso s/ Neto)
-        cursor.execute("""
-            UPDATE platos_maestro pm
-            INNER JOIN (
-                SELECT 
-                    d.codigo_plato_padre,
-                    COALESCE(SUM(d.cantidad_bruta * COALESCE(i.costo_unitario, c.costo_total_calculado, 0)), 0) as costo_total,
-                    COALESCE(SUM(d.cantidad_neta), 1) as peso_total
-                FROM platos_detalle d
-                LEFT JOIN ingredientes_supra i ON d.codigo_hijo = i.codigo_ingrediente
-                LEFT JOIN componentes_maestro c ON d.codigo_hijo = c.codigo_componente
-                GROUP BY d.codigo_plato_padre
-            ) calc ON pm.codigo_plato_supra = calc.codigo_plato_padre
-            SET pm.costo_total_calculado = calc.costo_total,
-                pm.peso_total_gramos = GREATEST(calc.peso_total, 1)
-        """)
-        conn.commit()
+        preparar_sesion_escritura(conn)
+        if completo:
+            cursor.execute("SELECT codigo_componente FROM componentes_maestro")
+            comps = [r[0] for r in cursor.fetchall()]
+            cursor.execute("SELECT codigo_plato_supra FROM platos_maestro")
+            plts = [r[0] for r in cursor.fetchall()]
+        else:
+            comps = set(componentes or [])
+            if insumos:
+                cursor.execute(f"SELECT DISTINCT codigo_padre FROM componentes_detalle WHERE codigo_hijo IN ({_marcas(insumos)})", tuple(insumos))
+                comps.update(r[0] for r in cursor.fetchall())
+            plts = set(platos or [])
+            hijos = list(insumos or []) + list(comps)
+            if hijos:
+                cursor.execute(f"SELECT DISTINCT codigo_plato_padre FROM platos_detalle WHERE codigo_hijo IN ({_marcas(hijos)})", tuple(hijos))
+                plts.update(r[0] for r in cursor.fetchall())
+        cursor.close()
+        conn.commit()  # cierra el snapshot de la búsqueda: cada lote lee lo vigente con locks
+
+        # Cada lote bloquea, lee, calcula (motor de costeo) y escribe en una sola transacción corta.
+        # Primero componentes: los lotes de platos ya leen sus costos nuevos
+        for lote in iterar_lotes(comps, LOTE_ESCRITURA):
+            ejecutar_con_reintentos(conn, lambda cur, lote=lote: _recostear_componentes(cur, lote))
+        for lote in iterar_lotes(plts, LOTE_ESCRITURA):
+            ejecutar_con_reintentos(conn, lambda cur, lote=lote: _recostear_platos(cur, lote))
     except Exception as e:
-        st.error(f"Error de optimización SQL: {e}")
+        st.error(f"Error de recálculo de costos: {e}")
     finally:
+        # Rollups del dashboard: solo las familias de los platos tocados (o todo, si la cascada fue completa)
+        try:
+            if completo: forzar_rollups_completos()
+            elif plts: marcar_rollups_platos(conn, list(plts))
+        except Exception:
+            forzar_rollups_completos()
         conn.close()
+        invalidar_catalogo()
+
+# --- LECTURA DE EXCEL SUBIDOS (STREAMING, SOLO LECTURA) ---
+LOTE_LECTURA = 2000  # filas por DataFrame entregado al pipeline de importación
+
+# Columnas requeridas por cada importador: nombre -> (dtype, valor si la columna no viene en el archivo)
+COLS_IMPORT_INSUMOS = {
+    'codigo': ('str', ''), 'descripcion': ('str', ''), 'um': ('str', 'UN'),
+    'costo_total_envase': ('float64', 0.0), 'cantidad_envase': ('float64', 1.0),
+}
+COLS_IMPORT_PLATOS = {
+    'ID_PLATO_FORZADO': ('str', ''), 'nombre_plato': ('str', ''), 'codigo_familia': ('str', ''),
+    'peso_total': ('float64', float('nan')), 'codigo_item': ('str', ''),
+    'cantidad': ('float64', 0.0), 'Merma': ('float64', 0.0),
+}
+
+def _celda_a_texto(v):
+    # Evita que un código numérico leído como float (30101.0) termine como '301010' al limpiar no-dígitos
+    if v is None: return ""
+    if isinstance(v, float) and v.is_integer(): return str(int(v))
+    return str(v).strip()
+
+def leer_hoja_en_lotes(archivo, hoja, columnas, tam=LOTE_LECTURA):
+    """Recorre una hoja con openpyxl en modo read-only y entrega DataFrames de hasta `tam` filas,
+    solo con las columnas pedidas y con dtypes explícitos. No carga el resto del libro.
+    Con hoja=None se lee la primera hoja."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        if hoja is None:
+            hoja = wb.sheetnames[0]
+        if hoja not in wb.sheetnames:
+            raise ValueError(f"El archivo no tiene la hoja '{hoja}'")
+        filas = wb[hoja].iter_rows(values_only=True)
+        encabezado = [str(c).strip() if c is not None else "" for c in next(filas, ())]
+        posiciones = {c: encabezado.index(c) for c in columnas if c in encabezado}
+
+        def _armar(buffer):
+            datos = {}
+            for c, (dtype, defecto) in columnas.items():
+                if c not in posiciones:
+                    datos[c] = [defecto] * len(buffer)
+                    continue
+                k = posiciones[c]
+                if dtype == 'str':
+                    datos[c] = [_celda_a_texto(f[k] if k < len(f) else None) for f in buffer]
+                else:
+                    datos[c] = pd.to_numeric(pd.Series([f[k] if k < len(f) else None for f in buffer], dtype=object), errors='coerce')
+            df = pd.DataFrame(datos)
+            return df.astype({c: ('object' if d == 'str' else d) for c, (d, _) in columnas.items()})
+
+        buffer = []
+        for f in filas:
+            if f is None or all(v is None for v in f): continue
+            buffer.append(f)
+            if len(buffer) >= tam:
+                yield _armar(buffer); buffer = []
+        if buffer:
+            yield _armar(buffer)
+    finally:
+        wb.close()
+
+def leer_encabezado(archivo, hoja=None):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        ws = wb[hoja] if hoja else wb[wb.sheetnames[0]]
+        return [str(c).strip() for c in next(ws.iter_rows(values_only=True), ()) if c is not None]
+    finally:
+        wb.close()
 
 def descargar_excel_simple(df, nombre_hoja="Datos"):
     output = io.BytesIO()
@@ -128,25 +562,391 @@ def get_next_code(prefix, tabla, columna):
     except:
         return f"{prefix}001"
 
-def get_item_cost(codigo):
+# --- CATÁLOGO COMPARTIDO (UNA COPIA POR PROCESO, DTYPES COMPACTOS) ---
+CATALOGO_TTL_S = 600
+CATALOGO_REINTENTO_S = 30  # tras una recarga fallida se sigue sirviendo lo que hay y no se reintenta antes
+
+@st.cache_resource
+def _catalogo_store():
+    # Todas las sesiones leen los mismos DataFrames; nunca se modifican in-place, se reemplazan al recargar.
+    # "lock" protege solo el estado; "carga" serializa la recarga (conexión + consultas) sin bloquear lecturas
+    return {"lock": threading.Lock(), "carga": threading.Lock(), "cargado": 0.0, "datos": None, "reintentar": 0.0}
+
+def invalidar_catalogo():
+    store = _catalogo_store()
+    with store["lock"]:
+        store["cargado"] = 0.0
+        store["reintentar"] = 0.0  # hubo una escritura: la DB responde
+    marcar_snapshot_desactualizado()
+
+def _compactar(df, enteros=(), categorias=(), flotantes=()):
+    # Códigos como enteros (el menor tipo que alcance), textos repetidos como category, costos como float64
+    for c in enteros:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    if enteros:
+        df = df.dropna(subset=list(enteros))
+        for c in enteros:
+            df[c] = pd.to_numeric(df[c], downcast='integer')
+    for c in categorias:
+        df[c] = df[c].astype('category')
+    for c in flotantes:
+        df[c] = pd.to_numeric(df[c], errors='coerce').astype('float64')
+    return df.reset_index(drop=True)
+
+def _cargar_catalogo():
+    # Primario: el catálogo alimenta grillas editables y no puede llegar atrasado respecto de la última escritura
+    conn = get_read_connection(replica=False)
+    if not conn: return None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        codigo_str = str(codigo)
-        if codigo_str.startswith('3'): 
-            cursor.execute("SELECT costo_unitario FROM ingredientes_supra WHERE codigo_ingrediente = %s", (codigo,))
-            res = cursor.fetchone()
-            return float(res[0]) if res else 0.0
-        elif codigo_str.startswith('2'): 
-            cursor.execute("SELECT costo_total_calculado FROM componentes_maestro WHERE codigo_componente = %s", (codigo,))
-            res = cursor.fetchone()
-            return float(res[0]) if res and res[0] else 0.0
+        ing = pd.read_sql(SNAPSHOT_CONSULTAS['ingredientes_supra'], conn)
+        comp = pd.read_sql(SNAPSHOT_CONSULTAS['componentes_maestro'], conn)
+        cls = pd.read_sql(SNAPSHOT_CONSULTAS['clasificacion_supra'], conn)
+    finally:
         conn.close()
-    except:
-        return 0.0
-    return 0.0
+    return _armar_catalogo(ing, comp, cls)
+
+def _catalogo_desde_snapshot(snap):
+    # Copias: _compactar convierte columnas y las tablas del snapshot son compartidas
+    return _armar_catalogo(snap['ingredientes_supra'].copy(), snap['componentes_maestro'].copy(), snap['clasificacion_supra'].copy())
+
+def _armar_catalogo(ing, comp, cls):
+    ing = _compactar(ing, enteros=['codigo_ingrediente'], categorias=['um', 'proveedor'],
+                     flotantes=['costo_total_envase', 'cantidad_envase', 'costo_unitario'])
+    ing['familia'] = ing['codigo_ingrediente'].astype(str).str[:5].astype('category')
+    comp = _compactar(comp, enteros=['codigo_componente'], flotantes=['costo_total_calculado'])
+    cls = _compactar(cls.astype({'codigo': str, 'codigo_final': str}), categorias=['tipo', 'sub_division'])
+
+    # Diccionario unificado de ítems (insumos Serie 30 + componentes Serie 20)
+    items = pd.concat([
+        pd.DataFrame({'codigo': ing['codigo_ingrediente'], 'descripcion': ing['descripcion'], 'costo': ing['costo_unitario']}),
+        pd.DataFrame({'codigo': comp['codigo_componente'], 'descripcion': comp['nombre_receta'], 'costo': comp['costo_total_calculado']}),
+    ], ignore_index=True).drop_duplicates('codigo').sort_values('descripcion', kind='stable').reset_index(drop=True)
+    items['codigo'] = pd.to_numeric(items['codigo'], downcast='integer')
+
+    fams_p = cls[cls['codigo_final'].str.startswith('10')]
+    return {
+        "ingredientes": ing,
+        "componentes": comp,
+        "clasificacion": cls,
+        "items_dic": items[['codigo', 'descripcion']],
+        "familias_dic": pd.DataFrame({'codigo': fams_p['codigo'], 'categoria': fams_p['tipo'].astype(str) + ' - ' + fams_p['sub_division'].astype(str)}).reset_index(drop=True),
+        "costos": items.set_index('codigo')['costo'].fillna(0.0),
+        # Listas de opciones para selectbox: se arman una vez por versión del catálogo, no por rerun
+        "opciones_items": (items['codigo'].astype(str) + " - " + items['descripcion']).tolist(),
+        "opciones_insumos": (ing['codigo_ingrediente'].astype(str) + " - " + ing['descripcion'] + " (" + ing['um'].astype(str) + ")").tolist(),
+    }
+
+def _catalogo_vencido(store):
+    ahora = time.time()
+    return (store["datos"] is None or ahora - store["cargado"] > CATALOGO_TTL_S) and ahora >= store["reintentar"]
+
+def get_catalogo():
+    store = _catalogo_store()
+    with store["lock"]:
+        datos = store["datos"]
+    if datos is None and snapshot_vigente():
+        # Arranque en frío: el snapshot local alcanza, sin esperar a MySQL
+        snap = leer_snapshot()
+        if snap:
+            desde_snap = _catalogo_desde_snapshot(snap)
+            with store["lock"]:
+                if store["datos"] is None:
+                    store["datos"], store["cargado"] = desde_snap, snap["generado"]
+                datos = store["datos"]
+
+    with store["lock"]:
+        vencido = _catalogo_vencido(store)
+    # Con datos en mano nadie espera a una recarga en curso de otra sesión; sin datos, no queda otra que esperarla
+    if vencido and store["carga"].acquire(blocking=datos is None):
+        try:
+            with store["lock"]:
+                vencido = _catalogo_vencido(store)  # otra sesión pudo recargar mientras se esperaba
+            if vencido:
+                # Conexión y consultas fuera de store["lock"]
+                try:
+                    nuevos = _cargar_catalogo()
+                except Exception:
+                    nuevos = None
+                with store["lock"]:
+                    if nuevos is not None:
+                        store["datos"], store["cargado"], store["reintentar"] = nuevos, time.time(), 0.0
+                    else:
+                        store["reintentar"] = time.time() + CATALOGO_REINTENTO_S
+        finally:
+            store["carga"].release()
+        with store["lock"]:
+            datos = store["datos"]
+
+    if datos is None:
+        # DB caída y nada cargado: se trabaja con el último snapshot disponible aunque esté viejo
+        snap = leer_snapshot()
+        if snap:
+            desde_snap = _catalogo_desde_snapshot(snap)
+            with store["lock"]:
+                if store["datos"] is None:
+                    store["datos"], store["cargado"] = desde_snap, snap["generado"]
+                datos = store["datos"]
+    return datos
+
+def catalogo_o_detener():
+    # Único punto de control para las páginas: sin DB ni snapshot no hay catálogo y se corta el rerun con un aviso
+    cat = get_catalogo()
+    if cat is None:
+        st.error("❌ No se pudo cargar el catálogo: la base de datos no responde y no hay snapshot local.")
+        st.stop()
+    return cat
+
+def opciones_clasificacion(serie):
+    cls = catalogo_o_detener()["clasificacion"]
+    cls = cls[cls['codigo_final'].str.startswith(serie)]
+    return (cls['codigo'] + " - " + cls['tipo'].astype(str) + " (" + cls['sub_division'].astype(str) + ")").tolist()
+
+# --- CONCILIACIÓN DE LISTAS DE PROVEEDOR (MATCHING APROXIMADO) ---
+STOPWORDS_MATCH = {"DE", "DEL", "LA", "EL", "LOS", "LAS", "Y", "CON", "SIN", "X", "POR", "EN", "P", "C"}
+SINONIMOS_MATCH = {"KGS": "KG", "KILO": "KG", "KILOS": "KG", "GRS": "GR", "G": "GR", "GRAMOS": "GR",
+                   "LTS": "LT", "LITRO": "LT", "LITROS": "LT", "L": "LT", "UNID": "UN", "UNIDAD": "UN", "UNIDADES": "UN"}
+MATCH_CANDIDATOS = 40     # candidatos por línea que pasan del bloqueo al scoring fino
+MATCH_SUGERENCIAS = 3
+MATCH_UMBRAL_AUTO = 0.75  # a partir de este score la sugerencia viene confirmada por defecto
+
+def normalizar_texto(texto):
+    # Mayúsculas sin acentos ni signos, unidades unificadas y sin palabras vacías
+    import unicodedata
+    t = unicodedata.normalize("NFKD", str(texto or "")).encode("ascii", "ignore").decode().upper()
+    t = re.sub(r"(\d)([A-Z])", r"\1 \2", re.sub(r"[^A-Z0-9]+", " ", t))
+    tokens = [SINONIMOS_MATCH.get(tok, tok) for tok in t.split()]
+    return " ".join(tok for tok in tokens if tok not in STOPWORDS_MATCH)
+
+def _trigramas(texto):
+    t = f"  {texto} "
+    return {t[k:k + 3] for k in range(len(t) - 2)}
+
+def construir_indice_match(descripciones):
+    """Índice de bloqueo sobre el maestro: posting lists de tokens y trigramas -> posiciones.
+    Los trigramas presentes en más del 20% del maestro no aportan y se descartan."""
+    textos = [normalizar_texto(d) for d in descripciones]
+    tokens, trigramas = {}, {}
+    for pos, t in enumerate(textos):
+        for tok in set(t.split()):
+            tokens.setdefault(tok, []).append(pos)
+        for tri in _trigramas(t):
+            trigramas.setdefault(tri, []).append(pos)
+    tope = max(50, int(len(textos) * 0.2))
+    trigramas = {tri: p for tri, p in trigramas.items() if len(p) <= tope}
+    return {"textos": textos, "tokens": tokens, "trigramas": trigramas}
+
+def _score_match(a, b):
+    # Promedio entre similitud de secuencia (typos, abreviaturas) y Jaccard de tokens (orden de palabras)
+    from difflib import SequenceMatcher
+    ta, tb = set(a.split()), set(b.split())
+    jac = len(ta & tb) / len(ta | tb) if ta and tb else 0.0
+    return 0.5 * SequenceMatcher(None, a, b, autojunk=False).ratio() + 0.5 * jac
+
+def buscar_coincidencias(indice, texto, n=MATCH_SUGERENCIAS):
+    from collections import Counter
+    q = normalizar_texto(texto)
+    if not q: return []
+    votos = Counter()
+    for tri in _trigramas(q):
+        votos.update(indice["trigramas"].get(tri, ()))
+    for tok in set(q.split()):
+        for pos in indice["tokens"].get(tok, ()):
+            votos[pos] += 3  # coincidir una palabra entera pesa más que un trigrama suelto
+    candidatos = [pos for pos, _ in votos.most_common(MATCH_CANDIDATOS)]
+    puntuados = sorted(((pos, _score_match(q, indice["textos"][pos])) for pos in candidatos), key=lambda x: -x[1])
+    return puntuados[:n]
+
+def get_indice_ingredientes(cat):
+    # Se construye una vez por versión del catálogo compartido y se guarda junto a él (en el mismo dict `cat`:
+    # las posiciones del índice corresponden a las filas de ese catálogo y no de otro más nuevo)
+    store = _catalogo_store()
+    with store["lock"]:
+        if "indice_match" not in cat:
+            cat["indice_match"] = construir_indice_match(cat["ingredientes"]['descripcion'].tolist())
+        return cat["indice_match"]
+
+def conciliar_lista_proveedor(df_lista, col_desc, cat):
+    """Propone, por cada línea de la lista del proveedor, los mejores ingredientes del maestro.
+    Etiquetas e índice salen del mismo catálogo `cat`."""
+    etiquetas = cat["opciones_insumos"]
+    indice = get_indice_ingredientes(cat)
+    filas = []
+    for desc in df_lista[col_desc]:
+        sugeridos = buscar_coincidencias(indice, desc)
+        opciones = [etiquetas[pos] for pos, _ in sugeridos]
+        mejor = sugeridos[0][1] if sugeridos else 0.0
+        filas.append({
+            'Ingrediente': opciones[0] if opciones else "",
+            'Score': round(mejor, 3),
+            'Alternativas': " | ".join(opciones[1:]),
+            'Confirmar': mejor >= MATCH_UMBRAL_AUTO,
+        })
+    return pd.DataFrame(filas, index=df_lista.index)
+
+# --- ANALÍTICA DASHBOARD (ROLLUPS POR FAMILIA) ---
+
+ROLLUP_TTL_S = 600  # reconstrucción completa periódica: cubre escrituras hechas fuera de este proceso
+
+@st.cache_resource
+def _rollup_store():
+    # Compartido entre sesiones: resumen por familia, familia de cada plato y familias marcadas por la cascada
+    return {"lock": threading.Lock(), "filas": {}, "info": {}, "plato_familia": {}, "sucias": set(),
+            "verificado": 0.0, "version": 0}
+
+def marcar_rollups_platos(conn, platos):
+    """La cascada avisa qué platos cambiaron: se marcan su familia actual y la que tenían en el rollup
+    (un plato reimportado puede haber cambiado de familia). Es una búsqueda por clave, sin recorrer la tabla."""
+    store = _rollup_store()
+    familias = set()
+    cursor = conn.cursor()
+    for lote in iterar_lotes(platos, LOTE_ESCRITURA):
+        cursor.execute(f"""
+            SELECT COALESCE(cs.codigo, 'S/F') FROM platos_maestro pm
+            LEFT JOIN clasificacion_supra cs ON pm.id_clasificacion = cs.codigo_final
+            WHERE pm.codigo_plato_supra IN ({_marcas(lote)})
+        """, tuple(lote))
+        familias.update(r[0] for r in cursor.fetchall())
+    cursor.close()
+    with store["lock"]:
+        familias.update(store["plato_familia"][str(p)] for p in platos if str(p) in store["plato_familia"])
+        store["sucias"] |= familias
+
+def forzar_rollups_completos():
+    store = _rollup_store()
+    with store["lock"]: store["verificado"] = 0.0
+
+def _calcular_rollup(grupo):
+    # grupo ya pasó por indicadores_costo (costo_kg, margen)
+    costo_kg = grupo['costo_kg'].dropna()
+    margen = grupo['margen'].fillna(0)
+    return {
+        'Platos': len(grupo),
+        'Costo x KG Prom. ($)': costo_kg.mean() if not costo_kg.empty else None,
+        'Costo x KG P50 ($)': costo_kg.quantile(0.5) if not costo_kg.empty else None,
+        'Costo x KG P90 ($)': costo_kg.quantile(0.9) if not costo_kg.empty else None,
+        'Margen P10 ($)': margen.quantile(0.1),
+        'Margen P50 ($)': margen.quantile(0.5),
+        'Margen P90 ($)': margen.quantile(0.9),
+    }
+
+def get_rollups_familias(conn):
+    """Rollups por familia, platos totales y versión (cambia cuando cambia algún rollup).
+    Solo se releen las familias marcadas por la cascada; todo el recetario, una vez cada ROLLUP_TTL_S.
+    Las consultas corren fuera del lock: un dashboard no hace esperar a los demás."""
+    store = _rollup_store()
+    with store["lock"]:
+        completo = time.time() - store["verificado"] > ROLLUP_TTL_S
+        sucias = set(store["sucias"])
+        store["sucias"].clear()
+
+    if completo or sucias:
+        filtro, params = "", None
+        if not completo:
+            filtro, params = f"WHERE COALESCE(cs.codigo, 'S/F') IN ({_marcas(sucias)})", tuple(sucias)
+        try:
+            df_pl = pd.read_sql(f"""
+                SELECT 
+                    COALESCE(cs.codigo, 'S/F') as familia,
+                    COALESCE(cs.tipo, 'SIN FAMILIA') as tipo,
+                    COALESCE(cs.sub_division, '-') as sub_division,
+                    pm.codigo_plato_supra,
+                    pm.costo_total_calculado,
+                    pm.peso_total_gramos
+                FROM platos_maestro pm
+                LEFT JOIN clasificacion_supra cs ON pm.id_clasificacion = cs.codigo_final
+                {filtro}
+            """, conn, params=params)
+        except Exception:
+            with store["lock"]: store["sucias"] |= sucias
+            raise
+        df_pl = indicadores_costo(df_pl, costo='costo_total_calculado')
+        nuevas = {f: (_calcular_rollup(g), (g['tipo'].iloc[0], g['sub_division'].iloc[0]), g['codigo_plato_supra'].astype(str).tolist())
+                  for f, g in df_pl.groupby('familia')}
+
+        with store["lock"]:
+            if completo:
+                store["filas"], store["info"], store["plato_familia"] = {}, {}, {}
+                store["verificado"] = time.time()
+            for f in sucias - set(nuevas):
+                store["filas"].pop(f, None); store["info"].pop(f, None)  # familia que quedó sin platos
+            for f, (rollup, info, pids) in nuevas.items():
+                store["filas"][f], store["info"][f] = rollup, info
+                store["plato_familia"].update(dict.fromkeys(pids, f))
+            store["version"] += 1
+
+    with store["lock"]:
+        filas = [{'Familia': f, 'Tipo': store["info"][f][0], 'Sub-división': store["info"][f][1], **store["filas"][f]}
+                 for f in sorted(store["filas"])]
+        version = store["version"]
+    df_roll = pd.DataFrame(filas)
+    return df_roll, int(df_roll['Platos'].sum()) if not df_roll.empty else 0, version
+
+@st.cache_data(ttl=600, max_entries=4)
+def get_catalogo_platos(version_rollups):
+    # version_rollups solo actúa como clave de caché: cambia cuando la cascada tocó algún costo/peso.
+    # Primario: una réplica atrasada dejaría guardados bajo la versión nueva los números viejos
+    conn = get_read_connection(replica=False)
+    if not conn: return pd.DataFrame()
+    pm = pd.read_sql("""
+        SELECT codigo_plato_supra, nombre_plato, peso_total_gramos, costo_total_calculado
+        FROM platos_maestro 
+        ORDER BY codigo_plato_supra DESC
+    """, conn)
+    conn.close()
+    return tabla_costos_platos(pm)
+
+def tabla_costos_platos(pm):
+    # Ingeniería de Menú: Costo x KG, Precio de Venta Sugerido (Costo / Target) y Margen de Contribución Unitario
+    pm = indicadores_costo(pm, costo='costo_total_calculado')
+    return pd.DataFrame({
+        'Código': pm['codigo_plato_supra'], 'Nombre': pm['nombre_plato'], 'Gramaje (g)': pm['peso_total_gramos'],
+        'Costo Total ($)': pm['costo_total_calculado'], 'Costo x KG ($)': pm['costo_kg'].round(2),
+        'Venta Sugerida (Sin IVA)': pm['venta_sugerida'], 'Margen ($)': pm['margen'],
+    })
+
+def _platos_con_familia_snapshot(snap):
+    pm = snap['platos_maestro'].copy()
+    cls = snap['clasificacion_supra'][['codigo', 'tipo', 'sub_division', 'codigo_final']].astype(str)
+    pm['_cls'] = pm['id_clasificacion'].astype(str)
+    pm = pm.merge(cls, how='left', left_on='_cls', right_on='codigo_final')
+    pm['familia'] = pm['codigo'].fillna('S/F')
+    pm['tipo'] = pm['tipo'].fillna('SIN FAMILIA'); pm['sub_division'] = pm['sub_division'].fillna('-')
+    return indicadores_costo(pm, costo='costo_total_calculado')
+
+def dashboard_desde_snapshot(snap):
+    """Mismos datos que el dashboard online (rollups + catálogo), calculados sobre el snapshot local."""
+    pm = _platos_con_familia_snapshot(snap)
+    df_roll = pd.DataFrame([
+        {'Familia': f, 'Tipo': g['tipo'].iloc[0], 'Sub-división': g['sub_division'].iloc[0], **_calcular_rollup(g)}
+        for f, g in pm.groupby('familia', sort=False)
+    ])
+    df_d = tabla_costos_platos(pm).sort_values('Código', ascending=False).reset_index(drop=True)
+    return len(snap['ingredientes_supra']), len(pm), df_roll, df_d
+
+def explotar_bom_snapshot(snap, ids_platos):
+    # Equivalente en pandas de las queries A (insumos directos) y B (insumos dentro de componentes)
+    ing = snap['ingredientes_supra'][['codigo_ingrediente', 'descripcion', 'um']].rename(
+        columns={'codigo_ingrediente': 'cod_insumo', 'descripcion': 'insumo'})
+    ing = ing.assign(_k=ing['cod_insumo'].astype(str))
+    # plato_id vuelve con el mismo tipo que los IDs de la grilla (para el .map del multiplicador)
+    ids = {str(i): i for i in ids_platos}
+    det = snap['platos_detalle']
+    det = det[det['codigo_plato_padre'].astype(str).isin(ids)]
+    det = det.assign(plato_id=det['codigo_plato_padre'].astype(str).map(ids), _k=det['codigo_hijo'].astype(str))
+
+    directos = det.merge(ing, on='_k')[['plato_id', 'cod_insumo', 'insumo', 'um', 'cantidad_bruta']].rename(columns={'cantidad_bruta': 'q_req'})
+
+    cd = snap['componentes_detalle']
+    cd = cd.assign(_k=cd['codigo_padre'].astype(str), _kh=cd['codigo_hijo'].astype(str))
+    ind = det.merge(cd, on='_k', suffixes=('', '_comp')).merge(ing.rename(columns={'_k': '_kh'}), on='_kh')
+    ind['q_req'] = ind['cantidad_bruta'] * ind['cantidad_bruta_comp']
+    indirectos = ind[['plato_id', 'cod_insumo', 'insumo', 'um', 'q_req']]
+    return pd.concat([directos, indirectos], ignore_index=True)
 
 # --- NAVEGACIÓN ---
+_t_inicio_rerun = time.perf_counter()
+st.session_state['_db_conexiones_rerun'] = 0
+asegurar_snapshot()
 st.sidebar.title("SUPRA Planta")
 menu = st.sidebar.radio("GESTIÓN PRINCIPAL", ["📊 Dashboard", "📦 Ingredientes", "🍳 Componentes", "🍽️ Platos Finales"])
 
@@ -161,10 +961,19 @@ menu = st.sidebar.radio("GESTIÓN PRINCIPAL", ["📊 Dashboard", "📦 Ingredien
 
 if menu == "📊 Dashboard":
     st.header("Dashboard de Gestión de Recetario")
-    conn = get_db_connection()
-    if conn:
-        c_i = pd.read_sql("SELECT COUNT(*) as t FROM ingredientes_supra", conn).iloc[0]['t']
-        c_p = pd.read_sql("SELECT COUNT(*) as t FROM platos_maestro", conn).iloc[0]['t']
+    # Primario: las familias marcadas por la cascada se releen una sola vez y se dan por frescas hasta la próxima
+    # marca (o ROLLUP_TTL_S); leerlas de una réplica atrasada fijaría los números viejos. Es una lectura acotada.
+    conn = get_read_connection(replica=False)
+    snap = None if conn else leer_snapshot()
+    if conn or snap:
+        if conn:
+            c_i = len(catalogo_o_detener()["ingredientes"])
+            df_roll, c_p, version_rollups = get_rollups_familias(conn)
+            conn.close()
+        else:
+            # Sin DB: todo el dashboard sale del snapshot local
+            c_i, c_p, df_roll, df_d = dashboard_desde_snapshot(snap)
+            aviso_snapshot(snap)
         
         k1, k2, k3 = st.columns([1, 1, 1])
         k1.metric("Insumos Base (30)", c_i)
@@ -176,51 +985,40 @@ if menu == "📊 Dashboard":
                 st.rerun()
         
         st.divider()
-        st.subheader("Catálogo con Análisis de Margen y Rentabilidad")
-        
-        # 1. Extracción de datos base
-        df_d = pd.read_sql("""
-            SELECT 
-                codigo_plato_supra as 'Código', 
-                nombre_plato as 'Nombre', 
-                peso_total_gramos as 'Gramaje (g)', 
-                costo_total_calculado as 'Costo Total ($)',
-                ROUND(costo_total_calculado / NULLIF(peso_total_gramos/1000, 0), 2) as 'Costo x KG ($)'
-            FROM platos_maestro 
-            ORDER BY codigo_plato_supra DESC
-        """, conn)
-
-        # 2. Lógica de Negocio: Ingeniería de Menú
-        # Definimos un Food Cost Objetivo (ej. 35% para SUPRA)
-        fc_target = 0.35 
+        st.subheader("Rentabilidad por Familia y Sub-división")
         
-        # Calculamos Precio de Venta Sugerido (Cost / Target)
-        df_d['Venta Sugerida (Sin IVA)'] = df_d['Costo Total ($)'] / fc_target
-        
-        # Calculamos el Margen de Contribución Unitario
-        df_d['Margen ($)'] = df_d['Venta Sugerida (Sin IVA)'] - df_d['Costo Total ($)']
+        fmt_pesos = st.column_config.NumberColumn(format="$ %.2f")
+        st.dataframe(
+            df_roll,
+            column_config={c: fmt_pesos for c in df_roll.columns if '($)' in c},
+            use_container_width=True, 
+            hide_index=True
+        )
+
+        st.divider()
+        st.subheader("Catálogo con Análisis de Margen y Rentabilidad")
         
-        # 3. Visualización con Formato Pro
+        if conn:
+            df_d = get_catalogo_platos(version_rollups)
+
+        # Sin Styler: el formato y la barra de Costo x KG los resuelve el cliente, sin importar el tamaño de la tabla
+        max_kg = float(df_d['Costo x KG ($)'].max()) if not df_d.empty and df_d['Costo x KG ($)'].notna().any() else 1.0
         st.dataframe(
-            df_d.style.format({
-                'Costo Total ($)': '${:,.2f}',
-                'Costo x KG ($)': '${:,.2f}',
-                'Gramaje (g)': '{:,.0f}',
-                'Venta Sugerida (Sin IVA)': '${:,.2f}',
-                'Margen ($)': '${:,.2f}'
-            }).background_gradient(
-                subset=['Costo x KG ($)'], 
-                cmap='YlOrRd'
-            ), 
+            df_d,
+            column_config={
+                'Costo Total ($)': st.column_config.NumberColumn(format="$ %.2f"),
+                'Costo x KG ($)': st.column_config.ProgressColumn(format="$ %.2f", min_value=0, max_value=max_kg),
+                'Gramaje (g)': st.column_config.NumberColumn(format="%.0f"),
+                'Venta Sugerida (Sin IVA)': st.column_config.NumberColumn(format="$ %.2f"),
+                'Margen ($)': st.column_config.NumberColumn(format="$ %.2f")
+            },
             use_container_width=True, 
             hide_index=True
         )
 
-        # 4. KPI de Salud del Recetario (Opcional pero recomendado para Broda)
-        avg_cost_kg = df_d['Costo x KG ($)'].mean()
+        # KPI de Salud del Recetario (Opcional pero recomendado para Broda)
+        avg_cost_kg = df_d['Costo x KG ($)'].mean() if not df_d.empty else 0.0
         st.info(f"💡 El costo promedio por KG en la planta SUPRA es de **${avg_cost_kg:,.2f}**")
-        
-        conn.close()
 
 # --- MODULO 1: INSUMOS ---
 elif menu == "📦 Ingredientes":
@@ -229,14 +1027,11 @@ elif menu == "📦 Ingredientes":
     with col_f1:
         with st.expander("➕ Cargar Nuevo Ingrediente Individual"):
             with st.form("new_ing"):
-                conn = get_db_connection()
-                df_cls = pd.read_sql("SELECT codigo, tipo, sub_division FROM clasificacion_supra WHERE codigo_final LIKE '3%'", conn)
-                conn.close()
+                ops_ins = opciones_clasificacion('3')
                 
                 c1, c2, c3 = st.columns(3)
                 with c1:
-                    if not df_cls.empty:
-                        ops_ins = df_cls.apply(lambda x: f"{x['codigo']} - {x['tipo']} ({x['sub_division']})", axis=1).tolist()
+                    if ops_ins:
                         fam_sel = st.selectbox("Categoría Insumo", ops_ins)
                         pre = fam_sel.split(" - ")[0]
                     else:
@@ -256,98 +1051,204 @@ elif menu == "📦 Ingredientes":
                     u_c = cost_e / cant_e if cant_e > 0 else 0
                     cursor.execute("INSERT INTO ingredientes_supra (codigo_ingrediente, descripcion, um, cantidad_envase, costo_total_envase, costo_unitario, proveedor) VALUES (%s,%s,%s,%s,%s,%s,%s)", (nuevo_id, desc, um, cant_e, cost_e, u_c, prov))
                     conn.commit()
-                    recalcular_costos_cascada()
+                    recalcular_costos_cascada(insumos=[nuevo_id])
+                    st.session_state.pop('snap_ing', None)
                     conn.close(); st.success(f"Guardado como {nuevo_id}"); st.rerun()
 
     with col_f2:
         with st.expander("📥 Importación Masiva (Subir Excel)"):
             st.write("Subí el diccionario con códigos de 5 dígitos para autosecuencia o códigos completos para forzar.")
+            if 'resumen_import_insumos' in st.session_state:
+                st.success(st.session_state.pop('resumen_import_insumos'))
             archivo_insumos = st.file_uploader("Elegir archivo .xlsx", type=['xlsx'], key="bulk_insumos_pro")
             
         if archivo_insumos and st.button("🚀 INICIAR IMPORTACIÓN", key="btn_import_insumos"):
             conn = None
+            nuevos = 0
+            actualizados = 0
+            sin_cambios = 0
+            codigos = []       # solo lo ya commiteado: es lo que va a la cascada pase lo que pase
+            fallidos = 0
+            error = None
             try:
-                df_migrar = pd.read_excel(archivo_insumos, sheet_name='DICCIONARIO_ITEMS').fillna("")
-                
                 conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("SET SESSION innodb_lock_wait_timeout = 300;")
-                cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
-
-                nuevos = 0
-                actualizados = 0
-
-                with st.status("Sincronizando maestro de insumos...", expanded=True):
-                    for i, row in df_migrar.iterrows():
-                        raw_val = str(row['codigo']).strip()
-                        cod_clean = re.sub(r'\D', '', raw_val)
-                        if not cod_clean: continue
-                        
-                        final_id = cod_clean
-                        if len(cod_clean) <= 5: nuevos += 1
-                        else: actualizados += 1
-                        
-                        try:
-                            c_total = float(row.get('costo_total_envase', 0))
-                            c_cant = float(row.get('cantidad_envase', 1))
-                        except:
-                            c_total, c_cant = 0.0, 1.0
-                        
-                        u_cost = c_total / c_cant if c_cant > 0 else 0
-                        u_medida = str(row.get('um', 'UN')).strip().upper()
-
-                        sql = """
-                            INSERT INTO ingredientes_supra 
-                            (codigo_ingrediente, descripcion, um, costo_total_envase, cantidad_envase, costo_unitario)
-                            VALUES (%s, %s, %s, %s, %s, %s) 
-                            ON DUPLICATE KEY UPDATE 
-                                descripcion=VALUES(descripcion), um=VALUES(um), costo_total_envase=VALUES(costo_total_envase), 
-                                cantidad_envase=VALUES(cantidad_envase), costo_unitario=VALUES(costo_unitario)
-                        """
-                        cursor.execute(sql, (final_id, str(row['descripcion']).upper().strip(), u_medida, c_total, c_cant, u_cost))
-                    
-                conn.commit()
-                cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
-                recalcular_costos_cascada()
-                st.success(f"✅ ¡Éxito! Insumos sincronizados.")
-                st.rerun()
+                preparar_sesion_escritura(conn)
+
+                # Upsert en lotes cortos: cada lote bloquea solo sus filas y libera al commitear
+                sql = """
+                    INSERT INTO ingredientes_supra 
+                    (codigo_ingrediente, descripcion, um, costo_total_envase, cantidad_envase, costo_unitario)
+                    VALUES (%s, %s, %s, %s, %s, %s) 
+                    ON DUPLICATE KEY UPDATE 
+                        descripcion=VALUES(descripcion), um=VALUES(um), costo_total_envase=VALUES(costo_total_envase), 
+                        cantidad_envase=VALUES(cantidad_envase), costo_unitario=VALUES(costo_unitario)
+                """
+
+                with st.status("Sincronizando maestro de insumos...", expanded=True) as status:
+                    # La hoja se lee en streaming: cada lote de filas se escribe antes de leer el siguiente
+                    for df_migrar in leer_hoja_en_lotes(archivo_insumos, 'DICCIONARIO_ITEMS', COLS_IMPORT_INSUMOS):
+                        filas = []
+                        for row in df_migrar.itertuples(index=False):
+                            cod_clean = re.sub(r'\D', '', row.codigo)
+                            if not cod_clean: continue
+                            
+                            final_id = cod_clean
+                            
+                            c_total, c_cant = row.costo_total_envase, row.cantidad_envase
+                            if pd.isna(c_total) or pd.isna(c_cant):
+                                c_total, c_cant = 0.0, 1.0
+                            
+                            u_cost = c_total / c_cant if c_cant > 0 else 0
+                            u_medida = row.um.strip().upper()
+                            filas.append((final_id, row.descripcion.upper().strip(), u_medida, c_total, c_cant, u_cost))
+
+                        # Huellas: las filas idénticas a la DB no se reescriben ni disparan recálculos
+                        cur = conn.cursor()
+                        en_db = huellas_insumos_db(cur, [f[0] for f in filas])
+                        cur.close()
+                        a_escribir = [f for f in filas if en_db.get(f[0]) != huella(*f[1:5])]
+                        sin_cambios += len(filas) - len(a_escribir)
+
+                        for lote in iterar_lotes(a_escribir, LOTE_ESCRITURA):
+                            fallidos = len(lote)
+                            ejecutar_con_reintentos(conn, lambda cur, lote=lote: cur.executemany(sql, lote))
+                            fallidos = 0
+                            codigos += [f[0] for f in lote]
+                            nuevos += sum(1 for f in lote if f[0] not in en_db)
+                            actualizados += sum(1 for f in lote if f[0] in en_db)
+                        status.write(f"{len(codigos)} insumos escritos, {sin_cambios} sin cambios...")
 
             except Exception as e:
-                if conn: 
-                    conn.rollback()
-                    cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
-                st.error(f"❌ Error crítico en insumos: {e}")
+                if conn: conn.rollback()
+                error = e
             finally:
                 if conn: conn.close()
+                # Los lotes ya commiteados se recalculan aunque uno posterior haya fallado
+                if codigos: recalcular_costos_cascada(insumos=codigos)
+                st.session_state.pop('snap_ing', None)
+
+            resumen = f"{nuevos} insumos nuevos, {actualizados} actualizados, {sin_cambios} sin cambios"
+            if error:
+                falla = f"Falló un lote de {fallidos} filas" if fallidos else "Falló la lectura"
+                st.error(f"❌ Importación incompleta: {error}. Aplicados: {resumen}. {falla} y el resto del archivo no se procesó; "
+                         "al volver a subirlo, lo ya aplicado se detecta sin cambios.")
+            else:
+                st.session_state.resumen_import_insumos = f"✅ Importación: {resumen}."
+                st.rerun()
                 
+    with st.expander("🔎 Conciliar Lista de Precios de Proveedor"):
+        st.write("Subí la lista del proveedor: se proponen los ingredientes más parecidos por descripción. Revisá, confirmá y aplicá los precios.")
+        archivo_prov = st.file_uploader("Lista del proveedor (.xlsx)", type=['xlsx'], key="lista_proveedor")
+        if archivo_prov:
+            # El encabezado se lee una vez por archivo subido, no en cada rerun
+            if st.session_state.get('prov_encabezado', (None,))[0] != archivo_prov.file_id:
+                st.session_state.prov_encabezado = (archivo_prov.file_id, leer_encabezado(archivo_prov))
+            cols_prov = st.session_state.prov_encabezado[1]
+            cp1, cp2, cp3 = st.columns(3)
+            col_desc = cp1.selectbox("Columna descripción", cols_prov, key="prov_col_desc")
+            col_precio = cp2.selectbox("Columna precio envase", cols_prov, key="prov_col_precio")
+            col_cant = cp3.selectbox("Columna cantidad envase (opcional)", ["(mantener actual)"] + cols_prov, key="prov_col_cant")
+
+            if st.button("🔎 BUSCAR COINCIDENCIAS", key="btn_conciliar"):
+                spec = {col_desc: ('str', ''), col_precio: ('float64', float('nan'))}
+                if col_cant != "(mantener actual)": spec[col_cant] = ('float64', float('nan'))
+                df_lista = pd.concat(list(leer_hoja_en_lotes(archivo_prov, None, spec)), ignore_index=True)
+                df_lista = df_lista.rename(columns={col_desc: 'Descripción Proveedor', col_precio: 'Precio Envase'})
+                df_lista['Cant. Envase'] = df_lista[col_cant] if col_cant in df_lista.columns else float('nan')
+                df_lista = df_lista[['Descripción Proveedor', 'Precio Envase', 'Cant. Envase']]
+                df_lista = df_lista[(df_lista['Descripción Proveedor'] != "") & df_lista['Precio Envase'].notna()].reset_index(drop=True)
+                t0 = time.perf_counter()
+                cat = catalogo_o_detener()  # una sola versión del catálogo para etiquetas, índice y _ver
+                st.session_state.conciliacion = pd.concat([df_lista, conciliar_lista_proveedor(df_lista, 'Descripción Proveedor', cat)], axis=1)
+                # Versión (_ver) de cada ingrediente al momento de conciliar: referencia al catálogo compartido, sin copia
+                st.session_state.conciliacion_base = cat["ingredientes"]
+                st.caption(f"{len(df_lista)} líneas conciliadas en {(time.perf_counter() - t0):,.2f} s")
+
+        if 'conciliacion' in st.session_state:
+            ed_conc = st.data_editor(st.session_state.conciliacion, use_container_width=True, hide_index=True, key="ed_conciliacion",
+                column_config={
+                    "Descripción Proveedor": st.column_config.Column(disabled=True),
+                    "Precio Envase": st.column_config.NumberColumn(format="$ %.2f", disabled=True),
+                    "Cant. Envase": st.column_config.NumberColumn(format="%.3f", disabled=True),
+                    "Ingrediente": st.column_config.SelectboxColumn("Ingrediente (✎)", options=[""] + catalogo_o_detener()["opciones_insumos"]),
+                    "Score": st.column_config.ProgressColumn(format="%.2f", min_value=0, max_value=1),
+                    "Alternativas": st.column_config.Column(disabled=True),
+                    "Confirmar": st.column_config.CheckboxColumn("Confirmar (✎)"),
+                })
+
+            if st.button("✅ APLICAR PRECIOS CONFIRMADOS", key="btn_aplicar_conciliacion"):
+                confirmados = ed_conc[ed_conc['Confirmar'] & (ed_conc['Ingrediente'].fillna("") != "")]
+                codigos = confirmados['Ingrediente'].str.split(" - ").str[0].astype(int)
+                repetidos = sorted(set(codigos[codigos.duplicated()].astype(str)))
+                if repetidos:
+                    st.error(f"❌ Hay más de una línea confirmada para: {', '.join(repetidos)}. Dejá una sola por ingrediente; no se aplicó nada.")
+                else:
+                    # Mismo camino que la grilla: fila completa versionada, costo unitario y cascada de lo aplicado
+                    base = st.session_state.conciliacion_base.set_index('codigo_ingrediente')
+                    texto = lambda v: None if pd.isna(v) else str(v)
+                    filas, conflictos = [], []
+                    for cod, (_, r) in zip(codigos, confirmados.iterrows()):
+                        if cod not in base.index:
+                            conflictos.append(str(cod)); continue  # alta posterior a la conciliación: sin versión para comparar
+                        b = base.loc[cod]
+                        precio = float(r['Precio Envase'])
+                        cant = float(b['cantidad_envase']) if pd.isna(r['Cant. Envase']) else float(r['Cant. Envase'])
+                        filas.append((b['descripcion'], texto(b['um']), precio, cant, precio / cant if cant > 0 else 0,
+                                      texto(b['proveedor']), int(cod), b['_ver']))
+                    conn = get_db_connection(); preparar_sesion_escritura(conn)
+                    conflictos += guardar_insumos_versionados(conn, filas)
+                    conn.close()
+                    aplicados = [str(f[6]) for f in filas if str(f[6]) not in conflictos]
+                    if aplicados: recalcular_costos_cascada(insumos=aplicados)
+                    st.session_state.pop('snap_ing', None)
+                    if conflictos:
+                        registrar_contencion("conflictos_edicion", len(conflictos))
+                        invalidar_catalogo()
+                        st.warning(f"⚠️ {len(aplicados)} precios aplicados. {len(conflictos)} ingrediente(s) cambiaron desde la conciliación "
+                                   f"y no se tocaron: {', '.join(conflictos)}. Volvé a buscar coincidencias para revisarlos.")
+                    else:
+                        st.session_state.pop('conciliacion', None); st.session_state.pop('conciliacion_base', None)
+                        st.success(f"✅ {len(filas)} precios actualizados desde la lista del proveedor.")
+                        st.rerun()
+
     st.divider()
-    conn = get_db_connection()
-    df_l = pd.read_sql("SELECT codigo_ingrediente, descripcion, um, costo_total_envase, cantidad_envase, costo_unitario, proveedor FROM ingredientes_supra ORDER BY codigo_ingrediente DESC", conn)
-    conn.close()
-    ed_df = st.data_editor(df_l, use_container_width=True, hide_index=True, key="ed_ing")
+    # Snapshot de la grilla: la versión (_ver) de cada fila se conserva hasta guardar, para detectar ediciones ajenas
+    # (referencia al DataFrame del catálogo compartido, no una copia por sesión)
+    if 'snap_ing' not in st.session_state:
+        st.session_state.snap_ing = catalogo_o_detener()["ingredientes"]
+    df_l = st.session_state.snap_ing
+    # UM y proveedor se editan como texto libre (en el catálogo son category)
+    ed_df = st.data_editor(df_l.astype({'um': 'object', 'proveedor': 'object'}), use_container_width=True, hide_index=True, key="ed_ing",
+                           column_config={"_ver": None, "familia": None})
     
     c_btn1, c_btn2 = st.columns(2)
     with c_btn1:
         if st.button("💾 GUARDAR CAMBIOS DE EDICIÓN"):
-            conn = get_db_connection(); cursor = conn.cursor()
-            for _, r in ed_df.iterrows():
+            cambios = filas_editadas(df_l, ed_df, ['descripcion', 'um', 'costo_total_envase', 'cantidad_envase', 'proveedor'])
+            filas = []
+            for _, r in cambios.iterrows():
                 c_envase = float(r['costo_total_envase'])
                 q_envase = float(r['cantidad_envase'])
                 new_u = c_envase / q_envase if q_envase > 0 else 0
-                
-                cursor.execute("""
-                    UPDATE ingredientes_supra 
-                    SET descripcion=%s, um=%s, costo_total_envase=%s, cantidad_envase=%s, costo_unitario=%s, proveedor=%s 
-                    WHERE codigo_ingrediente=%s
-                """, (r['descripcion'], r['um'], c_envase, q_envase, new_u, r['proveedor'], r['codigo_ingrediente']))
-            conn.commit()
-            recalcular_costos_cascada()
+                filas.append((r['descripcion'], r['um'], c_envase, q_envase, new_u, r['proveedor'], int(r['codigo_ingrediente']), r['_ver']))
+
+            conn = get_db_connection(); preparar_sesion_escritura(conn)
+            conflictos = guardar_insumos_versionados(conn, filas)
             conn.close()
-            st.success("Sincronizado")
-            st.rerun()
+
+            guardados = [str(f[6]) for f in filas if str(f[6]) not in conflictos]
+            if guardados: recalcular_costos_cascada(insumos=guardados)
+            st.session_state.pop('snap_ing', None); st.session_state.pop('ed_ing', None)
+            if conflictos:
+                registrar_contencion("conflictos_edicion", len(conflictos))
+                invalidar_catalogo()
+                st.warning(f"⚠️ {len(conflictos)} insumo(s) fueron modificados por otro usuario y no se guardaron: {', '.join(conflictos)}. La grilla se recarga con los valores actuales.")
+            else:
+                st.success("Sincronizado")
+                st.rerun()
 
     with c_btn2:
-        excel_ins = descargar_excel_simple(df_l, "Insumos")
+        excel_ins = descargar_excel_simple(df_l.drop(columns=['_ver', 'familia']), "Insumos")
         st.download_button(
             label="📥 Exportar Insumos (Excel)", 
             data=excel_ins, 
@@ -360,13 +1261,11 @@ elif menu == "🍳 Componentes":
     st.header("Elaboración de Componentes")
     with st.expander("➕ Crear Nuevo Componente"):
         if 'rows_c' not in st.session_state: st.session_state.rows_c = []
-        conn = get_db_connection()
-        df_cls_c = pd.read_sql("SELECT codigo, tipo, sub_division FROM clasificacion_supra WHERE codigo_final LIKE '2%'", conn)
+        ops_comp = opciones_clasificacion('2')
         
         c1, c2 = st.columns(2)
         nom_c = c1.text_input("Nombre de la Sub-receta")
-        if not df_cls_c.empty:
-            ops_comp = df_cls_c.apply(lambda x: f"{x['codigo']} - {x['tipo']} ({x['sub_division']})", axis=1).tolist()
+        if ops_comp:
             fam_c = c1.selectbox("Familia Componente", ops_comp)
         else:
             st.error("No hay categorías Serie 20")
@@ -374,22 +1273,26 @@ elif menu == "🍳 Componentes":
             
         tot_c_placeholder = c2.empty()
 
-        df_i = pd.read_sql("SELECT codigo_ingrediente as id, descripcion as n, um FROM ingredientes_supra", conn); conn.close()
-        ops_c = df_i.apply(lambda x: f"{x['id']} - {x['n']} ({x['um']})", axis=1).tolist()
+        ops_c = catalogo_o_detener()["opciones_insumos"]
 
         if st.button("➕ Añadir Insumo"): st.session_state.rows_c.append({"id": "", "cant": 0.0})
 
-        acum_c = 0.0
+        celdas_c = []
         for i, row in enumerate(st.session_state.rows_c):
             cols = st.columns([3, 1, 1])
             st.session_state.rows_c[i]['id'] = cols[0].selectbox(f"Insumo {i}", [""] + ops_c, key=f"c_s_{i}")
             st.session_state.rows_c[i]['cant'] = cols[1].number_input("Cant.", key=f"c_c_{i}", format="%.4f")
-            if st.session_state.rows_c[i]['id']:
-                p = get_item_cost(st.session_state.rows_c[i]['id'].split(" - ")[0])
-                sub = p * st.session_state.rows_c[i]['cant']; acum_c += sub
-                cols[2].write(f"${sub:.2f}")
+            celdas_c.append(cols[2])
+
+        # Vista previa con el motor de costeo sobre los precios del catálogo
+        lineas_c = pd.DataFrame([
+            {'fila': i, 'codigo_hijo': r['id'].split(" - ")[0], 'cantidad_bruta': float(r['cant'])}
+            for i, r in enumerate(st.session_state.rows_c) if r['id']
+        ], columns=['fila', 'codigo_hijo', 'cantidad_bruta'])
+        lineas_c = costear_lineas(lineas_c, catalogo_o_detener()["costos"])
+        for l in lineas_c.itertuples(): celdas_c[l.fila].write(f"${l.subtotal:.2f}")
 
-        tot_c_placeholder.metric("COSTO ESTIMADO", f"$ {acum_c:.2f}")
+        tot_c_placeholder.metric("COSTO ESTIMADO", f"$ {lineas_c['subtotal'].sum():.2f}")
 
         if st.button("💾 GUARDAR COMPONENTE"):
             if fam_c:
@@ -401,41 +1304,25 @@ elif menu == "🍳 Componentes":
                     if r['id']:
                         cursor.execute("INSERT INTO componentes_detalle (codigo_padre, codigo_hijo, cantidad_bruta) VALUES (%s,%s,%s)", (nc, r['id'].split(" - ")[0], r['cant']))
                 conn.commit()
-                recalcular_costos_cascada()
+                recalcular_costos_cascada(componentes=[nc])
                 conn.close(); st.success(f"Componente {nc} guardado."); st.session_state.rows_c = []; st.rerun()
 
     st.divider()
-    conn = get_db_connection()
-    df_comp = pd.read_sql("SELECT codigo_componente, nombre_receta, costo_total_calculado FROM componentes_maestro ORDER BY codigo_componente DESC", conn)
-    conn.close()
-    st.data_editor(df_comp, use_container_width=True, hide_index=True)
+    st.data_editor(catalogo_o_detener()["componentes"], use_container_width=True, hide_index=True)
 
 # --- MODULO 3: PLATOS ---
 elif menu == "🍽️ Platos Finales":
     st.header("Maestro de Recetas Finales")
     
-    @st.cache_data(ttl=600)
     def get_cached_dicts():
-        conn = get_db_connection()
-        if not conn: return pd.DataFrame(), pd.DataFrame()
-        
-        items = pd.read_sql("""
-            SELECT CAST(codigo_ingrediente AS CHAR) as codigo, descripcion FROM ingredientes_supra
-            UNION 
-            SELECT CAST(codigo_componente AS CHAR), nombre_receta FROM componentes_maestro
-            ORDER BY descripcion
-        """, conn)
-        
-        fams = pd.read_sql("""
-            SELECT codigo, CONCAT(tipo, ' - ', sub_division) as categoria 
-            FROM clasificacion_supra WHERE codigo_final LIKE '10%'
-        """, conn)
-        conn.close()
-        return items, fams
-
-    df_items_dic, df_fams_dic = get_cached_dicts()
+        # Vistas del catálogo compartido (sin copia por sesión)
+        cat = catalogo_o_detener()
+        return cat["items_dic"], cat["familias_dic"]
 
-    tabs = st.tabs(["✨ Crear Individual", "🚀 Carga Masiva", "✏️ Editar Receta", "📋 Ver Platos", "🏭 Ficha de Producción"])
+    # Navegación por vista: a diferencia de st.tabs (que ejecuta el cuerpo de todas las pestañas
+    # en cada rerun), solo se ejecuta la vista activa y sus consultas.
+    vista_p = st.radio("Vista", ["✨ Crear Individual", "🚀 Carga Masiva", "✏️ Editar Receta", "📋 Ver Platos", "🏭 Ficha de Producción"],
+                       horizontal=True, label_visibility="collapsed", key="vista_platos")
 
 
 
@@ -445,16 +1332,14 @@ elif menu == "🍽️ Platos Finales":
 
 
    # --- TAB 1: CREAR INDIVIDUAL ---
-    with tabs[0]:
+    if vista_p == "✨ Crear Individual":
         if 'rows_p' not in st.session_state: st.session_state.rows_p = []
-        conn = get_db_connection()
-        df_cls_p = pd.read_sql("SELECT codigo, tipo, sub_division FROM clasificacion_supra WHERE codigo_final LIKE '10%'", conn)
+        ops_plat = opciones_clasificacion('10')
         
         col_m1, col_m2 = st.columns(2)
         p_nom = col_m1.text_input("Nombre del Nuevo Plato").upper().strip()
         
-        if not df_cls_p.empty:
-            ops_plat = df_cls_p.apply(lambda x: f"{x['codigo']} - {x['tipo']} ({x['sub_division']})", axis=1).tolist()
+        if ops_plat:
             p_fam = col_m1.selectbox("Categoría de Plato", ops_plat)
         else:
             st.error("⚠️ No hay categorías Serie 10 cargadas.")
@@ -465,14 +1350,15 @@ elif menu == "🍽️ Platos Finales":
         p_gr = p_kg * 1000  
         p_tot_view = col_m2.empty()
 
-        ops_p = df_items_dic.apply(lambda x: f"{x['codigo']} - {x['descripcion']}", axis=1).tolist()
+        ops_p = catalogo_o_detener()["opciones_items"]
 
         if st.button("➕ Agregar Insumo/Sub-receta"): 
             st.session_state.rows_p.append({"id": "", "cant": 0.0, "merma": 0.0})
 
-        acum_p = 0.0
+        celdas_p = []
         for i, row in enumerate(st.session_state.rows_p):
             cols = st.columns([3, 1, 1, 1])
+            celdas_p.append(cols[3])
             st.session_state.rows_p[i]['id'] = cols[0].selectbox(f"Item {i}", [""] + ops_p, key=f"p_s_{i}")
             
             # Cantidad Bruta
@@ -480,20 +1366,23 @@ elif menu == "🍽️ Platos Finales":
             
             # Porcentaje de Merma
             st.session_state.rows_p[i]['merma'] = cols[2].number_input("Merma (%)", key=f"p_m_{i}", format="%.2f", value=float(row.get('merma', 0.0)))
-            
-            if st.session_state.rows_p[i]['id']:
-                cant_bruta = st.session_state.rows_p[i]['cant']
-                merma_pct = st.session_state.rows_p[i]['merma']
-                
-                # EL COSTO SE CALCULA SOBRE EL BRUTO (Lo que compramos)
-                val_costo = get_item_cost(st.session_state.rows_p[i]['id'].split(" - ")[0]) * cant_bruta
-                acum_p += val_costo
-                
-                # Visualizamos también el neto para control del usuario
-                cant_neta = cant_bruta * (1 - (merma_pct / 100.0))
-                cols[3].write(f"Costo: ${val_costo:.2f} | Neto: {cant_neta:.3f}")
         
-        p_tot_view.metric("COSTO TOTAL CALCULADO", f"$ {acum_p:.2f}")
+        # Vista previa con el motor de costeo y los precios del catálogo compartido: sin ir a la DB.
+        # EL COSTO SE CALCULA SOBRE EL BRUTO (Lo que compramos); el neto se muestra para control del usuario
+        lineas_p = pd.DataFrame([
+            {'codigo_plato_padre': 'nuevo', 'fila': i, 'codigo_hijo': r['id'].split(" - ")[0],
+             'cantidad_bruta': float(r['cant']), 'cantidad_neta': cantidad_neta(float(r['cant']), float(r['merma']))}
+            for i, r in enumerate(st.session_state.rows_p) if r['id']
+        ], columns=['codigo_plato_padre', 'fila', 'codigo_hijo', 'cantidad_bruta', 'cantidad_neta'])
+        lineas_p = costear_lineas(lineas_p, catalogo_o_detener()["costos"])
+        for l in lineas_p.itertuples():
+            celdas_p[l.fila].write(f"Costo: ${l.subtotal:.2f} | Neto: {l.cantidad_neta:.3f}")
+        
+        with p_tot_view.container():
+            st.metric("COSTO TOTAL CALCULADO", f"$ {lineas_p['subtotal'].sum():.2f}")
+            if not lineas_p.empty:
+                r_p = costear_recetas(lineas_p, catalogo_o_detener()["costos"]).iloc[0]
+                st.caption(f"Neto: {r_p.peso_total_gramos:,.0f} g | Costo x KG: ${r_p.costo_kg:,.2f} | Venta Sugerida: ${r_p.venta_sugerida:,.2f}")
 
         if st.button("💾 GUARDAR PLATO FINAL"):
             if p_fam and p_nom: 
@@ -512,7 +1401,7 @@ elif menu == "🍽️ Platos Finales":
                             cod_hijo = r['id'].split(" - ")[0]
                             c_bruta = float(r['cant'])
                             c_merma = float(r['merma'])
-                            c_neta = c_bruta * (1 - (c_merma / 100.0))
+                            c_neta = cantidad_neta(c_bruta, c_merma)
                             
                             detalles_insert.append((cid, cod_hijo, c_bruta, c_merma, c_neta))
                     
@@ -525,7 +1414,7 @@ elif menu == "🍽️ Platos Finales":
                         """, detalles_insert)
                         
                     conn.commit()
-                    recalcular_costos_cascada()
+                    recalcular_costos_cascada(platos=[cid])
                     st.success(f"Plato {cid} creado exitosamente.")
                     st.session_state.rows_p = []; st.rerun()
                 except Exception as e:
@@ -541,160 +1430,195 @@ elif menu == "🍽️ Platos Finales":
 
 
     # --- TAB 2: CARGA MASIVA (NUEVA ESTRUCTURA BRUTO/NETO) ---
-    with tabs[1]:
+    elif vista_p == "🚀 Carga Masiva":
         st.subheader("Importación Masiva de Recetas (Control por ID)")
         col_down1, col_down2 = st.columns(2)
         
         columnas_pro = ['ID_PLATO_FORZADO', 'nombre_plato', 'codigo_familia', 'peso_total', 'codigo_item', 'cantidad', 'Merma']
 
+        # Los Excel (con el join completo del recetario) se arman solo a pedido: no en cada rerun.
+        # Se guardan con la secuencia de escrituras: si hubo una importación o edición después, se descartan
+        # (no se ofrece un archivo viejo para reimportar ni queda el workbook en memoria de la sesión)
+        for k in ('xlsx_recetario', 'xlsx_plantilla'):
+            if k in st.session_state and st.session_state[k]['seq'] != secuencia_escrituras():
+                del st.session_state[k]
+
         with col_down1:
-            conn = get_db_connection()
-            if conn:
-                # SE ACTUALIZÓ LA QUERY: Ahora lee cantidad_bruta y porcentaje_merma
-                df_actual = pd.read_sql("""
-                    SELECT 
-                        p.codigo_plato_supra AS ID_PLATO_FORZADO,
-                        p.nombre_plato, 
-                        LEFT(p.codigo_plato_supra, 5) as codigo_familia, 
-                        (p.peso_total_gramos / 1000.0) as peso_total,
-                        CONCAT(d.codigo_hijo, ' - ', COALESCE(i.descripcion, c.nombre_receta)) as codigo_item, 
-                        COALESCE(d.cantidad_bruta, 0) as cantidad,
-                        COALESCE(d.porcentaje_merma, 0) as Merma
-                    FROM platos_maestro p
-                    LEFT JOIN platos_detalle d ON p.codigo_plato_supra = d.codigo_plato_padre
-                    LEFT JOIN ingredientes_supra i ON d.codigo_hijo = i.codigo_ingrediente
-                    LEFT JOIN componentes_maestro c ON d.codigo_hijo = c.codigo_componente
-                    ORDER BY p.codigo_plato_supra
-                """, conn)
-                conn.close()
-                btn_actual = descargar_excel_asistente(df_actual, df_items_dic, df_fams_dic)
-                st.download_button("📥 Descargar Recetario con IDs (Para Editar)", data=btn_actual, 
-                                   file_name=f"RECETARIO_SUPRA_CONTROL_{datetime.now().strftime('%Y%m%d')}.xlsx")
+            if st.button("⚙️ Preparar Recetario con IDs", key="btn_prep_recetario"):
+                df_items_dic, df_fams_dic = get_cached_dicts()
+                # Este archivo se edita y se vuelve a subir: siempre sale de una lectura consistente del primario,
+                # nunca del snapshot local ni de la réplica (una copia atrasada pisaría filas más nuevas al reimportar)
+                conn = get_read_connection(replica=False)
+                if conn:
+                    # SE ACTUALIZÓ LA QUERY: Ahora lee cantidad_bruta y porcentaje_merma
+                    df_actual = pd.read_sql("""
+                        SELECT 
+                            p.codigo_plato_supra AS ID_PLATO_FORZADO,
+                            p.nombre_plato, 
+                            LEFT(p.codigo_plato_supra, 5) as codigo_familia, 
+                            (p.peso_total_gramos / 1000.0) as peso_total,
+                            CONCAT(d.codigo_hijo, ' - ', COALESCE(i.descripcion, c.nombre_receta)) as codigo_item, 
+                            COALESCE(d.cantidad_bruta, 0) as cantidad,
+                            COALESCE(d.porcentaje_merma, 0) as Merma
+                        FROM platos_maestro p
+                        LEFT JOIN platos_detalle d ON p.codigo_plato_supra = d.codigo_plato_padre
+                        LEFT JOIN ingredientes_supra i ON d.codigo_hijo = i.codigo_ingrediente
+                        LEFT JOIN componentes_maestro c ON d.codigo_hijo = c.codigo_componente
+                        ORDER BY p.codigo_plato_supra
+                    """, conn)
+                    conn.close()
+                    st.session_state.xlsx_recetario = {'datos': descargar_excel_asistente(df_actual, df_items_dic, df_fams_dic),
+                                                       'seq': secuencia_escrituras(), 'generado': datetime.now()}
+            if 'xlsx_recetario' in st.session_state:
+                x = st.session_state.xlsx_recetario
+                st.download_button("📥 Descargar Recetario con IDs (Para Editar)", data=x['datos'], 
+                                   file_name=f"RECETARIO_SUPRA_CONTROL_{x['generado'].strftime('%Y%m%d_%H%M')}.xlsx")
+                st.caption(f"Generado {x['generado'].strftime('%d/%m/%Y %H:%M')}")
 
         with col_down2:
-            df_vacio = pd.DataFrame(columns=columnas_pro)
-            df_vacio.loc[0] = ["", "EJEMPLO: PLATO NUEVO", "10101", 0.500, "30101001 - ACEITUNAS", 0.250, 5]
-            btn_plantilla = descargar_excel_asistente(df_vacio, df_items_dic, df_fams_dic)
-            st.download_button("📄 Descargar Plantilla Vacía", data=btn_plantilla, file_name="PLANTILLA_MASIVA_SUPRA.xlsx")
+            if st.button("⚙️ Preparar Plantilla Vacía", key="btn_prep_plantilla"):
+                df_items_dic, df_fams_dic = get_cached_dicts()
+                df_vacio = pd.DataFrame(columns=columnas_pro)
+                df_vacio.loc[0] = ["", "EJEMPLO: PLATO NUEVO", "10101", 0.500, "30101001 - ACEITUNAS", 0.250, 5]
+                st.session_state.xlsx_plantilla = {'datos': descargar_excel_asistente(df_vacio, df_items_dic, df_fams_dic),
+                                                   'seq': secuencia_escrituras(), 'generado': datetime.now()}
+            if 'xlsx_plantilla' in st.session_state:
+                x = st.session_state.xlsx_plantilla
+                st.download_button("📄 Descargar Plantilla Vacía", data=x['datos'], file_name="PLANTILLA_MASIVA_SUPRA.xlsx")
+                st.caption(f"Generada {x['generado'].strftime('%d/%m/%Y %H:%M')}")
 
         st.divider()
+        if 'resumen_import_platos' in st.session_state:
+            st.success(st.session_state.pop('resumen_import_platos'))
         archivo_p = st.file_uploader("Subir Excel editado:", type=['xlsx'], key="bulk_p_fix_v2")
         
         if archivo_p and st.button("🚀 INICIAR IMPORTACIÓN", key="btn_import_platos"):
             conn = None
+            escritos = []      # pids ya commiteados: se recalculan aunque falle un lote posterior
+            plan, nuevos, fallidos, sin_cambios, error = [], set(), 0, 0, None
             try:
-                df_bulk = pd.read_excel(archivo_p, sheet_name='CARGA_RECETAS').fillna("")
-                
-                df_bulk['nombre_plato'] = df_bulk['nombre_plato'].astype(str).str.strip().str.upper()
-                df_bulk['codigo_familia'] = df_bulk['codigo_familia'].astype(str).str.replace(r'\D', '', regex=True)
-                
-                df_bulk['codigo_item'] = df_bulk['codigo_item'].astype(str).apply(lambda x: str(x).split(' - ')[0].strip() if ' - ' in str(x) else re.sub(r'\D', '', str(x)))
-                
-                if 'ID_PLATO_FORZADO' in df_bulk.columns:
-                    df_bulk['ID_PLATO_FORZADO'] = df_bulk['ID_PLATO_FORZADO'].astype(str).str.replace(r'\D', '', regex=True)
-
-                if 'Merma' in df_bulk.columns:
-                    df_bulk['Merma'] = pd.to_numeric(df_bulk['Merma'], errors='coerce').fillna(0)
-                else:
-                    df_bulk['Merma'] = 0
-
                 conn = get_db_connection(); cursor = conn.cursor()
+                preparar_sesion_escritura(conn)
                 local_counters = {}
-                p_count = 0
-                
-                cursor.execute("SET SESSION innodb_lock_wait_timeout = 500;")
-                cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
-                cursor.execute("SET UNIQUE_CHECKS = 0;")
+                clasif_cache = {}
+                plan = {}          # _group_key -> plato (las líneas de un plato pueden venir en lotes distintos)
+                saltados = set()
                 
                 with st.status("Procesando recetas...", expanded=True) as status:
-                    df_bulk['_group_key'] = df_bulk.get('ID_PLATO_FORZADO', '') + "_" + df_bulk['nombre_plato']
-                    grupos = df_bulk.groupby('_group_key')
-                    
-                    for key, grupo in grupos:
-                        row_h = grupo.iloc[0]
-                        nombre = str(row_h['nombre_plato']).strip()
-                        if not nombre or "EJEMPLO" in nombre: continue
-                        
-                        fam_prefix = str(row_h['codigo_familia'])[:5]
-                        forced_id = str(row_h.get('ID_PLATO_FORZADO', '')).strip()
-                        
-                        cursor.execute("SELECT codigo_final FROM clasificacion_supra WHERE codigo = %s LIMIT 1", (fam_prefix,))
-                        c_res = cursor.fetchone()
-                        if not c_res:
-                            status.write(f"⚠️ Familia {fam_prefix} no existe para '{nombre}'. Saltando.")
-                            continue
-                        id_cls_final = c_res[0]
-
-                        if forced_id and len(forced_id) >= 6:
-                            pid = forced_id 
-                        else:
-                            if fam_prefix not in local_counters:
-                                cursor.execute(f"SELECT MAX(codigo_plato_supra) FROM platos_maestro WHERE codigo_plato_supra LIKE '{fam_prefix}%'")
-                                db_max = cursor.fetchone()[0]
-                                local_counters[fam_prefix] = int(db_max) if db_max else int(f"{fam_prefix}000")
-                            local_counters[fam_prefix] += 1
-                            pid = str(local_counters[fam_prefix])
-
-                        try:
-                            peso_f = float(row_h['peso_total']) * 1000 if row_h['peso_total'] != "" else 0
-                        except:
-                            peso_f = 0
-                        
-                        cursor.execute("""
-                            INSERT INTO platos_maestro (codigo_plato_supra, nombre_plato, id_clasificacion, peso_total_gramos)
-                            VALUES (%s, %s, %s, %s)
-                            ON DUPLICATE KEY UPDATE 
-                                nombre_plato=VALUES(nombre_plato), 
-                                id_clasificacion=VALUES(id_clasificacion), 
-                                peso_total_gramos=VALUES(peso_total_gramos)
-                        """, (pid, nombre, id_cls_final, peso_f))
-
-                        cursor.execute("DELETE FROM platos_detalle WHERE codigo_plato_padre = %s", (pid,))
-
-                        detalles = []
-                        for _, row_d in grupo.iterrows():
-                            c_hijo = str(row_d['codigo_item'])
-                            if not c_hijo: continue
-                            
-                            try: cant_bruta = float(row_d['cantidad'])
-                            except: cant_bruta = 0.0
-
-                            try: merma_pct = float(row_d['Merma'])
-                            except: merma_pct = 0.0
-
-                            # LÓGICA DE MERMA: Rendimiento Real
-                            cant_neta = cant_bruta * (1 - (merma_pct / 100.0))
-
-                            if c_hijo.startswith('2'):
-                                cursor.execute("SELECT 1 FROM componentes_maestro WHERE codigo_componente = %s", (c_hijo,))
-                                if not cursor.fetchone():
-                                    cursor.execute("INSERT INTO componentes_maestro (codigo_componente, nombre_receta, costo_total_calculado) VALUES (%s, %s, 0)", 
-                                                 (c_hijo, f"AUTO-GEN: {c_hijo}"))
-
-                            # SE ACTUALIZÓ: Agregamos la tupla con los 3 valores
-                            detalles.append((pid, c_hijo, cant_bruta, merma_pct, cant_neta))
-                            
-                        if detalles:
-                            # SE ACTUALIZÓ: El INSERT ahora ataca las 3 columnas nuevas
-                            cursor.executemany("""
-                                INSERT INTO platos_detalle 
-                                (codigo_plato_padre, codigo_hijo, cantidad_bruta, porcentaje_merma, cantidad_neta) 
-                                VALUES (%s,%s,%s,%s,%s)
-                            """, detalles)
-                        
-                        p_count += 1
-                
-                conn.commit()
-                cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
-                cursor.execute("SET UNIQUE_CHECKS = 1;")
-                recalcular_costos_cascada()
-                status.update(label=f"¡Éxito! Se sincronizaron {p_count} platos.", state="complete")
-                st.rerun()
+                    # 1. Armado del plan (solo lecturas, sin bloqueos), leyendo la hoja en streaming
+                    for df_bulk in leer_hoja_en_lotes(archivo_p, 'CARGA_RECETAS', COLS_IMPORT_PLATOS):
+                        df_bulk['nombre_plato'] = df_bulk['nombre_plato'].str.strip().str.upper()
+                        df_bulk['codigo_familia'] = df_bulk['codigo_familia'].str.replace(r'\D', '', regex=True)
+                        df_bulk['codigo_item'] = df_bulk['codigo_item'].apply(lambda x: x.split(' - ')[0].strip() if ' - ' in x else re.sub(r'\D', '', x))
+                        df_bulk['ID_PLATO_FORZADO'] = df_bulk['ID_PLATO_FORZADO'].str.replace(r'\D', '', regex=True)
+                        df_bulk['Merma'] = df_bulk['Merma'].fillna(0.0)
+                        df_bulk['cantidad'] = df_bulk['cantidad'].fillna(0.0)
+                        df_bulk['_group_key'] = df_bulk['ID_PLATO_FORZADO'] + "_" + df_bulk['nombre_plato']
+
+                        for key, grupo in df_bulk.groupby('_group_key', sort=False):
+                            if key in saltados: continue
+                            if key not in plan:
+                                row_h = grupo.iloc[0]
+                                nombre = row_h['nombre_plato']
+                                if not nombre or "EJEMPLO" in nombre:
+                                    saltados.add(key); continue
+                                
+                                fam_prefix = row_h['codigo_familia'][:5]
+                                forced_id = row_h['ID_PLATO_FORZADO'].strip()
+                                
+                                if fam_prefix not in clasif_cache:
+                                    cursor.execute("SELECT codigo_final FROM clasificacion_supra WHERE codigo = %s LIMIT 1", (fam_prefix,))
+                                    c_res = cursor.fetchone()
+                                    clasif_cache[fam_prefix] = c_res[0] if c_res else None
+                                id_cls_final = clasif_cache[fam_prefix]
+                                if id_cls_final is None:
+                                    status.write(f"⚠️ Familia {fam_prefix} no existe para '{nombre}'. Saltando.")
+                                    saltados.add(key); continue
+
+                                if forced_id and len(forced_id) >= 6:
+                                    pid = forced_id 
+                                else:
+                                    if fam_prefix not in local_counters:
+                                        cursor.execute(f"SELECT MAX(codigo_plato_supra) FROM platos_maestro WHERE codigo_plato_supra LIKE '{fam_prefix}%'")
+                                        db_max = cursor.fetchone()[0]
+                                        local_counters[fam_prefix] = int(db_max) if db_max else int(f"{fam_prefix}000")
+                                    local_counters[fam_prefix] += 1
+                                    pid = str(local_counters[fam_prefix])
+
+                                peso_f = float(row_h['peso_total']) * 1000 if pd.notna(row_h['peso_total']) else 0
+                                plan[key] = {"pid": pid, "cabecera": (pid, nombre, id_cls_final, peso_f), "detalles": []}
+
+                            pid = plan[key]["pid"]
+                            for row_d in grupo.itertuples(index=False):
+                                c_hijo = row_d.codigo_item
+                                if not c_hijo: continue
+                                cant_bruta = float(row_d.cantidad)
+                                merma_pct = float(row_d.Merma)
+
+                                # LÓGICA DE MERMA: Rendimiento Real
+                                cant_neta = cantidad_neta(cant_bruta, merma_pct)
+                                plan[key]["detalles"].append((pid, c_hijo, cant_bruta, merma_pct, cant_neta))
+                    plan = list(plan.values())
+
+                    # 1b. Huellas: se compara cada plato del archivo con su estado actual en la DB y se descartan los iguales
+                    en_db = huellas_platos_db(cursor, [p["pid"] for p in plan])
+                    cursor.close()
+                    nuevos = {p["pid"] for p in plan if p["pid"] not in en_db}
+                    cambiados = [p for p in plan if p["pid"] in en_db and en_db[p["pid"]] != huella_plato(
+                        p["cabecera"][1], p["cabecera"][2], p["cabecera"][3], [(d[1], d[2], d[3]) for d in p["detalles"]])]
+                    sin_cambios = len(plan) - len(nuevos) - len(cambiados)
+                    plan = [p for p in plan if p["pid"] in nuevos] + cambiados
+                    status.write(f"{len(nuevos)} nuevos, {len(cambiados)} modificados, {sin_cambios} sin cambios.")
+
+                    # 2. Escritura en transacciones cortas de LOTE_PLATOS platos: solo se bloquean esas filas
+                    def _escribir_platos(cur, lote):
+                        for p in lote:
+                            cur.execute("""
+                                INSERT INTO platos_maestro (codigo_plato_supra, nombre_plato, id_clasificacion, peso_total_gramos)
+                                VALUES (%s, %s, %s, %s)
+                                ON DUPLICATE KEY UPDATE 
+                                    nombre_plato=VALUES(nombre_plato), 
+                                    id_clasificacion=VALUES(id_clasificacion), 
+                                    peso_total_gramos=VALUES(peso_total_gramos)
+                            """, p["cabecera"])
+
+                            cur.execute("DELETE FROM platos_detalle WHERE codigo_plato_padre = %s", (p["pid"],))
+
+                            auto_comps = [(d[1], f"AUTO-GEN: {d[1]}") for d in p["detalles"] if d[1].startswith('2')]
+                            if auto_comps:
+                                cur.executemany("""
+                                    INSERT INTO componentes_maestro (codigo_componente, nombre_receta, costo_total_calculado) VALUES (%s, %s, 0)
+                                    ON DUPLICATE KEY UPDATE codigo_componente = codigo_componente
+                                """, auto_comps)
+
+                            if p["detalles"]:
+                                cur.executemany("""
+                                    INSERT INTO platos_detalle 
+                                    (codigo_plato_padre, codigo_hijo, cantidad_bruta, porcentaje_merma, cantidad_neta) 
+                                    VALUES (%s,%s,%s,%s,%s)
+                                """, p["detalles"])
+
+                    for lote in iterar_lotes(plan, LOTE_PLATOS):
+                        fallidos = len(lote)
+                        ejecutar_con_reintentos(conn, lambda cur, lote=lote: _escribir_platos(cur, lote))
+                        fallidos = 0
+                        escritos += [p["pid"] for p in lote]
             except Exception as e:
                 if conn: conn.rollback()
-                st.error(f"❌ Error en la importación masiva: {e}")
+                error = e
             finally:
                 if conn: conn.close()
+                # Solo los platos escritos pasan al recálculo de costos, también si la importación quedó a medias
+                if escritos: recalcular_costos_cascada(platos=escritos)
+
+            n_nuevos = sum(1 for pid in escritos if pid in nuevos)
+            resumen = f"{n_nuevos} platos nuevos, {len(escritos) - n_nuevos} actualizados, {sin_cambios} sin cambios"
+            if error:
+                falla = f"Falló un lote de {fallidos} platos y quedaron {len(plan) - len(escritos)} sin escribir" if fallidos else "Falló la preparación del plan"
+                st.error(f"❌ Importación incompleta: {error}. Aplicados: {resumen}. {falla}; al volver a subir el archivo, lo ya aplicado se detecta sin cambios.")
+            else:
+                st.session_state.resumen_import_platos = f"✅ Importación: {resumen}."
+                st.rerun()
 
 
 
@@ -704,7 +1628,7 @@ elif menu == "🍽️ Platos Finales":
 
 
     # --- TAB 3: EDICIÓN ---
-    with tabs[2]:
+    elif vista_p == "✏️ Editar Receta":
         st.subheader("Editor Técnico de Recetas")
         conn = get_db_connection()
         if conn:
@@ -715,24 +1639,28 @@ elif menu == "🍽️ Platos Finales":
                 row_p = df_ex[df_ex['n'] == plato_sel].iloc[0]
                 c_ed = row_p['cod']
                 
-                # Extraemos las 3 columnas de control de volumen
-                det = pd.read_sql(f"""
-                    SELECT d.id_detalle_plato, d.codigo_hijo, COALESCE(i.descripcion, c.nombre_receta) as item,
-                           d.cantidad_bruta, d.porcentaje_merma, d.cantidad_neta, COALESCE(i.um, 'N/A') as unidad,
-                           COALESCE(i.costo_unitario, c.costo_total_calculado) as costo_un
-                    FROM platos_detalle d
-                    LEFT JOIN ingredientes_supra i ON d.codigo_hijo = i.codigo_ingrediente
-                    LEFT JOIN componentes_maestro c ON d.codigo_hijo = c.codigo_componente
-                    WHERE d.codigo_plato_padre = '{c_ed}'
-                """, conn)
-                
-                # Subtotal en base a lo comprado (Bruto)
-                det['subtotal'] = det['cantidad_bruta'] * det['costo_un'].fillna(0)
+                # Extraemos las 3 columnas de control de volumen (+ versión de fila para concurrencia optimista).
+                # El snapshot se mantiene mientras se edita el mismo plato.
+                snap = st.session_state.get('snap_det')
+                if not snap or snap['cod'] != c_ed:
+                    snap = {'cod': c_ed, 'df': pd.read_sql("""
+                        SELECT d.id_detalle_plato, d.codigo_hijo, COALESCE(i.descripcion, c.nombre_receta) as item,
+                               d.cantidad_bruta, d.porcentaje_merma, d.cantidad_neta, COALESCE(i.um, 'N/A') as unidad,
+                               MD5(CONCAT_WS('|', d.cantidad_bruta, d.porcentaje_merma, d.cantidad_neta)) as _ver
+                        FROM platos_detalle d
+                        LEFT JOIN ingredientes_supra i ON d.codigo_hijo = i.codigo_ingrediente
+                        LEFT JOIN componentes_maestro c ON d.codigo_hijo = c.codigo_componente
+                        WHERE d.codigo_plato_padre = %s
+                    """, conn, params=(c_ed,))}
+                    st.session_state.snap_det = snap
+                # Costo x UM y subtotal (en base a lo comprado, Bruto) con el motor de costeo y los precios del catálogo
+                det = costear_lineas(snap['df'], catalogo_o_detener()["costos"])
                 
                 # Data Editor con bloqueo inteligente de celdas
                 ed_det = st.data_editor(det, use_container_width=True, hide_index=True,
                     column_config={
                         "id_detalle_plato": None,
+                        "_ver": None,
                         "codigo_hijo": st.column_config.Column("Código", disabled=True),
                         "item": st.column_config.Column("Insumo / Componente", disabled=True),
                         "unidad": st.column_config.Column("UM", disabled=True),
@@ -743,25 +1671,52 @@ elif menu == "🍽️ Platos Finales":
                         "subtotal": st.column_config.NumberColumn("Costo Item", format="$ %.2f", disabled=True)
                     }
                 )
+
+                # Vista previa de la ficha con los valores editados, antes de guardar
+                previa = ed_det.assign(codigo_plato_padre=c_ed, cantidad_neta=cantidad_neta(ed_det['cantidad_bruta'].astype(float), ed_det['porcentaje_merma'].astype(float)))
+                r_prev = costear_recetas(previa, catalogo_o_detener()["costos"])
+                if not r_prev.empty:
+                    r_prev = r_prev.iloc[0]
+                    m1, m2, m3, m4 = st.columns(4)
+                    m1.metric("Costo Total", f"$ {r_prev.costo_total:,.2f}")
+                    m2.metric("Peso Neto", f"{r_prev.peso_total_gramos:,.0f} g")
+                    m3.metric("Costo x KG", f"$ {r_prev.costo_kg:,.2f}")
+                    m4.metric("Venta Sugerida", f"$ {r_prev.venta_sugerida:,.2f}")
                 
                 if st.button("💾 ACTUALIZAR FICHA"):
-                    cursor = conn.cursor()
-                    for _, r in ed_det.iterrows():
-                        # Recalculamos la neta en backend por si editaron Bruta o Merma en la UI
-                        c_bruta = float(r['cantidad_bruta'])
-                        p_merma = float(r['porcentaje_merma'])
-                        c_neta = c_bruta * (1 - (p_merma / 100.0))
-                        
-                        cursor.execute("""
-                            UPDATE platos_detalle 
-                            SET cantidad_bruta=%s, porcentaje_merma=%s, cantidad_neta=%s 
-                            WHERE id_detalle_plato=%s
-                        """, (c_bruta, p_merma, c_neta, r['id_detalle_plato']))
-                    
-                    conn.commit()
-                    recalcular_costos_cascada()
-                    st.success("Receta actualizada y rendimientos recalculados.")
-                    st.rerun()
+                    cambios = filas_editadas(det, ed_det, ['cantidad_bruta', 'porcentaje_merma'])
+
+                    def _guardar_detalle(cursor):
+                        rechazados = []
+                        for _, r in cambios.iterrows():
+                            # Recalculamos la neta en backend por si editaron Bruta o Merma en la UI
+                            c_bruta = float(r['cantidad_bruta'])
+                            p_merma = float(r['porcentaje_merma'])
+                            c_neta = cantidad_neta(c_bruta, p_merma)
+                            
+                            # Solo si la línea sigue como la leímos (nadie la editó ni reimportó el plato)
+                            cursor.execute("""
+                                UPDATE platos_detalle 
+                                SET cantidad_bruta=%s, porcentaje_merma=%s, cantidad_neta=%s 
+                                WHERE id_detalle_plato=%s
+                                  AND MD5(CONCAT_WS('|', cantidad_bruta, porcentaje_merma, cantidad_neta)) = %s
+                            """, (c_bruta, p_merma, c_neta, r['id_detalle_plato'], r['_ver']))
+                            if cursor.rowcount == 0: rechazados.append(str(r['item']))
+                        if rechazados:
+                            # La ficha se guarda completa o no se guarda: se descarta la transacción
+                            conn.rollback()
+                        return rechazados
+
+                    preparar_sesion_escritura(conn)
+                    conflictos = ejecutar_con_reintentos(conn, _guardar_detalle)
+                    st.session_state.pop('snap_det', None)
+                    if conflictos:
+                        registrar_contencion("conflictos_edicion", len(conflictos))
+                        st.warning(f"⚠️ Otro usuario modificó esta ficha ({', '.join(conflictos)}). No se guardaron cambios; la ficha se recarga con los valores actuales.")
+                    else:
+                        recalcular_costos_cascada(platos=[c_ed])
+                        st.success("Receta actualizada y rendimientos recalculados.")
+                        st.rerun()
             conn.close()
 
 
@@ -769,21 +1724,18 @@ elif menu == "🍽️ Platos Finales":
 
 
     # --- TAB 4: VISOR ---
-    with tabs[3]:
+    elif vista_p == "📋 Ver Platos":
         st.subheader("Visor de Producción")
-        conn = get_db_connection()
+        conn = get_read_connection()
         if conn:
             # Añadimos el cálculo del costo por KG para tener la info completa aquí también
             df_res = pd.read_sql("""
-                SELECT 
-                    codigo_plato_supra as 'Código', 
-                    nombre_plato as 'Plato', 
-                    peso_total_gramos as 'Gramaje Real (N)', 
-                    costo_total_calculado as 'Costo Total ($)',
-                    ROUND(costo_total_calculado / NULLIF(peso_total_gramos/1000, 0), 2) as 'Costo x KG ($)'
+                SELECT codigo_plato_supra, nombre_plato, peso_total_gramos, costo_total_calculado
                 FROM platos_maestro 
                 ORDER BY codigo_plato_supra DESC
             """, conn)
+            df_res = tabla_costos_platos(df_res)[['Código', 'Nombre', 'Gramaje (g)', 'Costo Total ($)', 'Costo x KG ($)']].rename(
+                columns={'Nombre': 'Plato', 'Gramaje (g)': 'Gramaje Real (N)'})
             
             st.dataframe(df_res.style.format({
                 'Gramaje Real (N)': '{:,.0f} g',
@@ -794,19 +1746,28 @@ elif menu == "🍽️ Platos Finales":
 
 
             # --- TAB 5: FICHA DE PRODUCCIÓN (MRP) ---
-    with tabs[4]:
+    elif vista_p == "🏭 Ficha de Producción":
         st.subheader("Ficha de Producción y Explosión de Materiales")
         st.write("Ingresá la cantidad a producir por plato. El sistema calculará el Picking List exacto (en Bruto).")
         
-        conn = get_db_connection()
-        if conn:
+        # Grilla y explosión BOM salen del mismo snapshot: el local (Parquet) si está al día o la DB no responde,
+        # si no una transacción de lectura consistente
+        snap = leer_snapshot() if snapshot_vigente() else None
+        conn = None if snap else get_read_connection()
+        if not snap and not conn: snap = leer_snapshot()
+        if snap or conn:
             # 1. Grilla editable para ingresar cantidades a producir
-            df_platos = pd.read_sql("SELECT codigo_plato_supra as ID, nombre_plato as Plato, 0 as Cantidad FROM platos_maestro ORDER BY Plato", conn)
+            if snap:
+                aviso_snapshot(snap)
+                df_platos = pd.DataFrame({'ID': snap['platos_maestro']['codigo_plato_supra'], 'Plato': snap['platos_maestro']['nombre_plato'], 'Cantidad': 0}).sort_values('Plato').reset_index(drop=True)
+            else:
+                df_platos = pd.read_sql("SELECT codigo_plato_supra as ID, nombre_plato as Plato, 0 as Cantidad FROM platos_maestro ORDER BY Plato", conn)
             
             ed_prod = st.data_editor(
                 df_platos, 
                 use_container_width=True, 
                 hide_index=True,
+                key="ed_prod",
                 column_config={
                     "ID": st.column_config.Column("Código", disabled=True),
                     "Plato": st.column_config.Column("Plato Final", disabled=True),
@@ -858,10 +1819,13 @@ elif menu == "🍽️ Platos Finales":
                     """
                     
                     try:
-                        df_dir = pd.read_sql(query_directos, conn)
-                        df_indir = pd.read_sql(query_indirectos, conn)
-                        
-                        df_total = pd.concat([df_dir, df_indir], ignore_index=True)
+                        if snap:
+                            df_total = explotar_bom_snapshot(snap, ids_platos)
+                        else:
+                            df_dir = pd.read_sql(query_directos, conn)
+                            df_indir = pd.read_sql(query_indirectos, conn)
+                            
+                            df_total = pd.concat([df_dir, df_indir], ignore_index=True)
                         
                         if not df_total.empty:
                             df_total['Multiplicador'] = df_total['plato_id'].map(platos_dict)
@@ -905,4 +1869,10 @@ elif menu == "🍽️ Platos Finales":
                         st.error(f"Error generando Picking List: {e}")
                         # TIP SENIOR: Si salta error acá, revisá si en la tabla componentes_detalle tenés la columna 'cantidad_bruta'.
                         # Si tu columna se llama diferente en componentes_detalle (ej. cantidad_neta, cantidad_inicial), avisame y lo ajustamos.
-            conn.close()
\ No newline at end of file
+            if conn: conn.close()
+
+# --- MÉTRICAS DE RERUN ---
+st.sidebar.caption(f"⏱️ Render: {(time.perf_counter() - _t_inicio_rerun) * 1000:,.0f} ms | Conexiones DB: {st.session_state.get('_db_conexiones_rerun', 0)}")
+_cont = _contencion_store()
+st.sidebar.caption(f"🔒 Esperas lock: {_cont['esperas_lock']} | Deadlocks: {_cont['deadlocks']} | Reintentos: {_cont['reintentos']} | "
+                   f"Conflictos edición: {_cont['conflictos_edicion']} | Lotes: {_cont['lotes']} (máx {_cont['lote_max_ms']:,.0f} ms)")
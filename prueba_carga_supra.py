@@ -0,0 +1,266 @@
+"""Prueba de carga de SUPRA: N planificadores simultáneos sobre app_supra.py, sin navegador.
+
+Cada sesión es un AppTest de Streamlit en su propio proceso que recorre un guion realista:
+mirar el dashboard, editar precios de insumos, guardar una receta, generar un picking list y
+correr una importación masiva. Se mide la latencia de cada acción y los errores, para cada
+nivel de concurrencia.
+
+Un proceso por sesión porque AppTest.run() reemplaza estado global de Streamlit (st.secrets,
+Runtime._instance) y no admite corridas simultáneas en hilos. Por eso las sesiones NO comparten
+las cachés de proceso (catálogo, rollups, snapshot) como en un servidor real: la concurrencia
+medida es la de la base de datos, no la de esas cachés.
+
+Corre contra una base MySQL local de prueba (nunca contra producción):
+
+    SUPRA_CARGA_DB_HOST=127.0.0.1 SUPRA_CARGA_DB_USER=root SUPRA_CARGA_DB_PASS=... \\
+        python prueba_carga_supra.py --sembrar --sesiones 1,2,4,8 --iteraciones 3
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mysql.connector
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_supra.py")
+TIMEOUT_S = 180
+
+DB = {
+    "DB_HOST": os.environ.get("SUPRA_CARGA_DB_HOST", "127.0.0.1"),
+    "DB_USER": os.environ.get("SUPRA_CARGA_DB_USER", "root"),
+    "DB_PASS": os.environ.get("SUPRA_CARGA_DB_PASS", ""),
+    "DB_NAME": os.environ.get("SUPRA_CARGA_DB_NAME", "supra_carga"),
+}
+
+ESQUEMA = [
+    """CREATE TABLE IF NOT EXISTS clasificacion_supra (
+        codigo VARCHAR(10) NOT NULL, tipo VARCHAR(100), sub_division VARCHAR(100),
+        codigo_final VARCHAR(20) NOT NULL PRIMARY KEY)""",
+    """CREATE TABLE IF NOT EXISTS ingredientes_supra (
+        codigo_ingrediente BIGINT NOT NULL PRIMARY KEY, descripcion VARCHAR(255), um VARCHAR(10),
+        costo_total_envase DECIMAL(14,4) DEFAULT 0, cantidad_envase DECIMAL(14,4) DEFAULT 1,
+        costo_unitario DECIMAL(16,6) DEFAULT 0, proveedor VARCHAR(120))""",
+    """CREATE TABLE IF NOT EXISTS componentes_maestro (
+        codigo_componente BIGINT NOT NULL PRIMARY KEY, nombre_receta VARCHAR(255),
+        costo_total_calculado DECIMAL(16,4) DEFAULT 0)""",
+    """CREATE TABLE IF NOT EXISTS componentes_detalle (
+        id_detalle INT AUTO_INCREMENT PRIMARY KEY, codigo_padre BIGINT NOT NULL, codigo_hijo BIGINT NOT NULL,
+        cantidad_bruta DECIMAL(14,4) DEFAULT 0, INDEX (codigo_padre), INDEX (codigo_hijo))""",
+    """CREATE TABLE IF NOT EXISTS platos_maestro (
+        codigo_plato_supra BIGINT NOT NULL PRIMARY KEY, nombre_plato VARCHAR(255), id_clasificacion VARCHAR(20),
+        peso_total_gramos DECIMAL(14,2) DEFAULT 0, costo_total_calculado DECIMAL(16,4) DEFAULT 0)""",
+    """CREATE TABLE IF NOT EXISTS platos_detalle (
+        id_detalle_plato INT AUTO_INCREMENT PRIMARY KEY, codigo_plato_padre BIGINT NOT NULL, codigo_hijo BIGINT NOT NULL,
+        cantidad_bruta DECIMAL(14,4) DEFAULT 0, porcentaje_merma DECIMAL(6,2) DEFAULT 0, cantidad_neta DECIMAL(14,4) DEFAULT 0,
+        INDEX (codigo_plato_padre), INDEX (codigo_hijo))""",
+]
+
+PALABRAS = ["POLLO", "CARNE", "CERDO", "PAPA", "CEBOLLA", "ZANAHORIA", "ARROZ", "FIDEOS", "CREMA",
+            "MANTECA", "HUEVO", "AJO", "PIMIENTO", "OREGANO", "TOMATE", "QUESO", "HARINA", "ACEITE"]
+
+
+# --- BASE DE PRUEBA ---
+def conectar(con_base=True):
+    datos = dict(host=DB["DB_HOST"], user=DB["DB_USER"], password=DB["DB_PASS"])
+    if con_base: datos["database"] = DB["DB_NAME"]
+    return mysql.connector.connect(**datos)
+
+def sembrar(n_insumos, n_componentes, n_platos, semilla=7):
+    """Recrea la base de prueba con un recetario sintético de tamaño controlado."""
+    rnd = random.Random(semilla)
+    conn = conectar(con_base=False); cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{DB['DB_NAME']}`")
+    cursor.execute(f"CREATE DATABASE `{DB['DB_NAME']}`")
+    cursor.execute(f"USE `{DB['DB_NAME']}`")
+    for ddl in ESQUEMA: cursor.execute(ddl)
+
+    cursor.executemany("INSERT INTO clasificacion_supra VALUES (%s,%s,%s,%s)", [
+        ("30101", "INSUMOS", "SECOS", "30101"), ("30102", "INSUMOS", "FRESCOS", "30102"),
+        ("20101", "COMPONENTES", "SALSAS", "20101"),
+        ("10101", "PLATOS", "PASTAS", "10101"), ("10102", "PLATOS", "CARNES", "10102"), ("10103", "PLATOS", "VEGETARIANOS", "10103"),
+    ])
+
+    insumos = []
+    for k in range(n_insumos):
+        cod = int(f"{rnd.choice(['30101', '30102'])}{k + 1:03d}") if k < 999 else 30100000 + k
+        envase, cant = round(rnd.uniform(500, 50000), 2), rnd.choice([1, 5, 10, 25])
+        insumos.append((cod, " ".join(rnd.sample(PALABRAS, 3)) + f" {cant} KG", rnd.choice(["KG", "LT", "UN"]),
+                        envase, cant, envase / cant, f"PROVEEDOR {rnd.randint(1, 20)}"))
+    insumos = list({i[0]: i for i in insumos}.values())
+    cursor.executemany("INSERT INTO ingredientes_supra VALUES (%s,%s,%s,%s,%s,%s,%s)", insumos)
+    cods_ins = [i[0] for i in insumos]
+
+    comps = [20101000 + k + 1 for k in range(n_componentes)]
+    cursor.executemany("INSERT INTO componentes_maestro (codigo_componente, nombre_receta) VALUES (%s,%s)",
+                       [(c, f"SALSA {' '.join(rnd.sample(PALABRAS, 2))}") for c in comps])
+    cursor.executemany("INSERT INTO componentes_detalle (codigo_padre, codigo_hijo, cantidad_bruta) VALUES (%s,%s,%s)",
+                       [(c, h, round(rnd.uniform(0.01, 1), 4)) for c in comps for h in rnd.sample(cods_ins, 4)])
+
+    platos, detalles = [], []
+    for k in range(n_platos):
+        fam = rnd.choice(["10101", "10102", "10103"])
+        cod = int(fam) * 1000 + k + 1 if k < 999 else int(fam) * 100000 + k
+        platos.append((cod, f"PLATO {' '.join(rnd.sample(PALABRAS, 2))} {k}", fam))
+        for h in rnd.sample(cods_ins, 6) + rnd.sample(comps, 1):
+            bruta, merma = round(rnd.uniform(0.02, 0.5), 4), rnd.choice([0, 5, 10])
+            detalles.append((cod, h, bruta, merma, bruta * (1 - merma / 100)))
+    platos = list({p[0]: p for p in platos}.values())
+    cursor.executemany("INSERT INTO platos_maestro (codigo_plato_supra, nombre_plato, id_clasificacion) VALUES (%s,%s,%s)", platos)
+    cursor.executemany("INSERT INTO platos_detalle (codigo_plato_padre, codigo_hijo, cantidad_bruta, porcentaje_merma, cantidad_neta) "
+                       "VALUES (%s,%s,%s,%s,%s)", [d for d in detalles if d[0] in {p[0] for p in platos}])
+    conn.commit(); conn.close()
+    print(f"Base '{DB['DB_NAME']}' sembrada: {len(insumos)} insumos, {len(comps)} componentes, {len(platos)} platos.")
+
+def excel_importacion(n_platos, rnd):
+    """Libro CARGA_RECETAS con platos existentes (IDs forzados) y cantidades retocadas."""
+    conn = conectar()
+    df = pd.read_sql("""
+        SELECT p.codigo_plato_supra AS ID_PLATO_FORZADO, p.nombre_plato, LEFT(p.codigo_plato_supra, 5) AS codigo_familia,
+               p.peso_total_gramos / 1000.0 AS peso_total, d.codigo_hijo AS codigo_item, d.cantidad_bruta AS cantidad,
+               d.porcentaje_merma AS Merma
+        FROM platos_maestro p JOIN platos_detalle d ON p.codigo_plato_supra = d.codigo_plato_padre
+    """, conn)
+    conn.close()
+    elegidos = rnd.sample(sorted(df['ID_PLATO_FORZADO'].unique()), min(n_platos, df['ID_PLATO_FORZADO'].nunique()))
+    df = df[df['ID_PLATO_FORZADO'].isin(elegidos)].copy()
+    df['cantidad'] = pd.to_numeric(df['cantidad']) * rnd.uniform(0.9, 1.1)
+    salida = io.BytesIO()
+    with pd.ExcelWriter(salida, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='CARGA_RECETAS')
+    return salida.getvalue()
+
+
+# --- ACCIONES DE UN PLANIFICADOR ---
+def _boton(at, etiqueta):
+    return next(b for b in at.button if b.label == etiqueta)
+
+def _ir_a(at, modulo, vista=None):
+    at.sidebar.radio[0].set_value(modulo).run()
+    if vista:
+        at.radio(key="vista_platos").set_value(vista).run()
+
+def accion_dashboard(at, rnd):
+    _ir_a(at, "📊 Dashboard")
+
+def accion_editar_precios(at, rnd):
+    _ir_a(at, "📦 Ingredientes")
+    filas = {str(rnd.randrange(20)): {"costo_total_envase": round(rnd.uniform(500, 50000), 2)} for _ in range(3)}
+    at.session_state["ed_ing"] = {"edited_rows": filas, "added_rows": [], "deleted_rows": []}
+    _boton(at, "💾 GUARDAR CAMBIOS DE EDICIÓN").click().run()
+
+def accion_guardar_receta(at, rnd):
+    _ir_a(at, "🍽️ Platos Finales", "✨ Crear Individual")
+    next(t for t in at.text_input if t.label == "Nombre del Nuevo Plato").input(f"CARGA {rnd.randrange(10**6)}")
+    for _ in range(3):
+        _boton(at, "➕ Agregar Insumo/Sub-receta").click().run()
+    for k in range(3):
+        item = at.selectbox(key=f"p_s_{k}")
+        item.set_value(rnd.choice(item.options[1:]))
+        at.number_input(key=f"p_c_{k}").set_value(round(rnd.uniform(0.05, 0.5), 4))
+    at.run()
+    _boton(at, "💾 GUARDAR PLATO FINAL").click().run()
+
+def accion_picking_list(at, rnd):
+    _ir_a(at, "🍽️ Platos Finales", "🏭 Ficha de Producción")
+    filas = {str(rnd.randrange(50)): {"Cantidad": rnd.randint(1, 40)} for _ in range(10)}
+    at.session_state["ed_prod"] = {"edited_rows": filas, "added_rows": [], "deleted_rows": []}
+    _boton(at, "⚙️ GENERAR PICKING LIST").click().run()
+
+def accion_importar(at, rnd):
+    _ir_a(at, "🍽️ Platos Finales", "🚀 Carga Masiva")
+    at.file_uploader(key="bulk_p_fix_v2").upload("carga.xlsx", excel_importacion(30, rnd),
+                                                 "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    at.run()
+    at.button(key="btn_import_platos").click().run()
+
+# Guion de un planificador: mayormente consultas, algunas escrituras, una importación cada tanto
+GUION = [("dashboard", accion_dashboard, 4), ("editar_precios", accion_editar_precios, 2),
+         ("guardar_receta", accion_guardar_receta, 2), ("picking_list", accion_picking_list, 3),
+         ("importar", accion_importar, 1)]
+
+
+# --- EJECUCIÓN ---
+def _iniciar_proceso(ruta_secrets, dir_base):
+    # Credenciales desde un secrets.toml temporal (solo DB_*: ningún DB_READ_* de ~/.streamlit se cuela),
+    # sin at.secrets; y un snapshot Parquet propio por proceso para que los volcados no se pisen
+    from streamlit import config
+    config.set_option("secrets.files", [ruta_secrets])
+    os.environ["SUPRA_SNAPSHOT_DIR"] = tempfile.mkdtemp(prefix="snapshot_", dir=dir_base)
+
+def nueva_sesion():
+    return AppTest.from_file(APP, default_timeout=TIMEOUT_S).run()
+
+def correr_sesion(id_sesion, iteraciones):
+    resultados = []
+    rnd = random.Random(id_sesion)
+    at = nueva_sesion()
+    for _ in range(iteraciones):
+        for nombre, accion, peso in GUION:
+            for _ in range(peso):
+                t0 = time.perf_counter(); error = None
+                try:
+                    accion(at, rnd)
+                    if at.exception: error = at.exception[0].value
+                    elif at.error: error = at.error[0].value
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                resultados.append({"accion": nombre, "ms": (time.perf_counter() - t0) * 1000, "error": error})
+                if error:
+                    at = nueva_sesion()  # la sesión queda en un estado incierto: se arranca una nueva
+    return resultados
+
+def _pct(valores, p):
+    return statistics.quantiles(valores, n=100, method="inclusive")[p - 1] if len(valores) > 1 else valores[0]
+
+def reporte(nivel, resultados, segundos):
+    df = pd.DataFrame(resultados)
+    print(f"\n=== {nivel} sesiones concurrentes | {len(df)} acciones en {segundos:,.1f} s ({len(df) / segundos:,.2f} acc/s) ===")
+    print(f"{'acción':<16}{'n':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'máx ms':>10}{'errores':>9}")
+    for accion, g in df.groupby("accion", sort=False):
+        ms = g["ms"].tolist()
+        print(f"{accion:<16}{len(g):>6}{_pct(ms, 50):>10,.0f}{_pct(ms, 90):>10,.0f}{_pct(ms, 99):>10,.0f}{max(ms):>10,.0f}{g['error'].notna().sum():>9}")
+    for err, n in df["error"].dropna().value_counts().head(5).items():
+        print(f"  ⚠️ {n}x {str(err)[:140]}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sesiones", default="1,2,4,8", help="niveles de concurrencia, separados por coma")
+    ap.add_argument("--iteraciones", type=int, default=2, help="vueltas del guion por sesión")
+    ap.add_argument("--sembrar", action="store_true", help="recrear la base de prueba antes de empezar")
+    ap.add_argument("--insumos", type=int, default=800)
+    ap.add_argument("--componentes", type=int, default=80)
+    ap.add_argument("--platos", type=int, default=600)
+    args = ap.parse_args()
+
+    if args.sembrar:
+        sembrar(args.insumos, args.componentes, args.platos)
+
+    # Directorio temporal de la prueba: secrets.toml con la base de prueba y los snapshots Parquet de cada
+    # proceso (ni se escribe la base de prueba en el snapshot de producción, ni uno de producción desvía lecturas)
+    dir_base = tempfile.mkdtemp(prefix="supra_carga_")
+    ruta_secrets = os.path.join(dir_base, "secrets.toml")
+    with open(ruta_secrets, "w") as f:
+        f.writelines(f"{k} = {json.dumps(v)}\n" for k, v in DB.items())
+    try:
+        for nivel in [int(n) for n in args.sesiones.split(",")]:
+            resultados = []
+            t0 = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=nivel, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_iniciar_proceso, initargs=(ruta_secrets, dir_base)) as pool:
+                for f in [pool.submit(correr_sesion, k, args.iteraciones) for k in range(nivel)]:
+                    resultados += f.result()
+            reporte(nivel, resultados, time.perf_counter() - t0)
+    finally:
+        shutil.rmtree(dir_base, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()